@@ -0,0 +1,243 @@
+"""
+Quota and anomaly alerts, updated incrementally after each snapshot.
+
+For each (namespace, owner) we keep the resource-hours used in the last `window` hours,
+as a fixed-size ring of hourly buckets, plus a running mean/variance (EWMA) of that
+usage. Only the snapshots taken since the last run are processed, so the archive is
+never re-scanned and the state does not grow with time.
+
+Alerts:
+* `quota`: resource-hours used in the window are above a threshold,
+* `anomaly`: resource-hours used in the window are unusually high for that owner,
+* `queued`: a job has been queued for too long.
+
+Alerts are appended to `alerts/alerts.ndjson` and, optionally, sent to a hook command
+(that receives each alert as JSON in stdin):
+    python alerts.py --hook "mail -s 'Accounting alert' admin@example.com"
+"""
+
+from datetime import datetime, timedelta
+import json
+import math
+from pathlib import Path
+import subprocess
+
+import typer
+
+import archive
+import conf
+from cube import split
+from queue_times import submit_dt
+from usage_stats import iter_usage
+
+
+main_dir = Path(__file__).resolve().parent
+alert_dir = main_dir / "alerts"
+alerts_pth = alert_dir / "alerts.ndjson"
+state_pth = alert_dir / "state.json"
+
+resources = [  # resources tracked in the sliding window
+    "gpu_num",
+    "cpu_num",
+]
+EPOCH = datetime(1970, 1, 1)
+ALPHA = 0.1  # smoothing factor of the running mean/variance
+MIN_SAMPLES = 12  # runs needed before the running mean/variance is trusted
+
+
+def new_ring(
+    window: int,
+):
+    """
+    Create an empty ring of hourly buckets.
+    """
+    ring = {"hours": [-1] * window}
+    for r in resources:
+        ring[r] = [0.0] * window
+        ring[f"{r}_mean"] = 0.0
+        ring[f"{r}_var"] = 0.0
+    ring["samples"] = 0
+    ring["active"] = []  # alerts currently active (to avoid repeating them)
+    return ring
+
+
+def add(
+    ring: dict,
+    hour: int,
+    usage: dict,
+):
+    """
+    Add resource-hours to the bucket of a given hour (hours since epoch).
+    Buckets of hours that fell out of the window are reused.
+    """
+    i = hour % len(ring["hours"])
+    if ring["hours"][i] != hour:
+        ring["hours"][i] = hour
+        for r in resources:
+            ring[r][i] = 0.0
+    for r in resources:
+        ring[r][i] += usage[r]
+
+
+def total(
+    ring: dict,
+    hour: int,
+    r: str,
+):
+    """
+    Resource-hours used in the window ending at a given hour (hours since epoch).
+    """
+    window = len(ring["hours"])
+    return sum(v for h, v in zip(ring["hours"], ring[r]) if hour - window < h <= hour)
+
+
+def emit(
+    alert: dict,
+    hook: str = None,
+):
+    """
+    Save an alert, and send it to the hook command (if any).
+    """
+    print(f"ALERT {json.dumps(alert)}")
+    with open(alerts_pth, "a") as f:
+        f.write(json.dumps(alert) + "\n")
+    if hook:
+        subprocess.run(hook, shell=True, input=json.dumps(alert), text=True)
+
+
+def main(
+    window: int = 24,
+    max_gpu_hours: float = 100,
+    max_cpu_hours: float = 1000,
+    max_queue_hours: float = 48,
+    zscore: float = 4,
+    hook: str = None,
+):
+    """
+    Update the alert state with the new snapshots, and emit alerts.
+
+    * **window**: length (in hours) of the sliding window, only used when the state is
+      created.
+    * **max_gpu_hours**, **max_cpu_hours**: max resource-hours per owner and namespace
+      in the window.
+    * **max_queue_hours**: max hours a job can be queued.
+    * **zscore**: how many standard deviations above the usual usage of an owner is
+      considered an anomaly.
+    * **hook**: shell command to send the alerts to (alert as JSON in stdin).
+    """
+    alert_dir.mkdir(exist_ok=True)
+    thresholds = {"gpu_num": max_gpu_hours, "cpu_num": max_cpu_hours}
+
+    state = {"window": window, "owners": {}, "queued": []}
+    if state_pth.exists():
+        with open(state_pth, "r") as f:
+            state = json.load(f)
+
+    # Only process the snapshots since the last run (or the last one, on first run)
+    end_dt = archive.list_snapshots()[-1][0]
+    if "last_snapshot" in state:
+        prev_snapshot_dt = datetime.fromisoformat(state["last_snapshot"])
+        ini_dt = prev_snapshot_dt + timedelta(seconds=1)
+    else:
+        prev_snapshot_dt = None
+        ini_dt = end_dt
+    if end_dt < ini_dt:
+        print("Alerts are already up to date")
+        return
+
+    owners = state["owners"]
+    for namespace, job, start, end in iter_usage(
+        ini_dt=ini_dt,
+        end_dt=end_dt,
+        namespaces=conf.NAMESPACES,
+        prev_snapshot_dt=prev_snapshot_dt,
+    ):
+        ns_owners = owners.setdefault(namespace, {})
+        ring = ns_owners.setdefault(job["owner"], new_ring(state["window"]))
+        for bucket, seconds in split(start, end, "hour"):
+            hour = int((bucket - EPOCH).total_seconds() // 3600)
+            usage = {r: job["resources"][r] * seconds / 3600 for r in resources}
+            add(ring, hour, usage)
+
+    # Check quotas and anomalies
+    now = int((end_dt - EPOCH).total_seconds() // 3600)
+    for namespace, ns_owners in owners.items():
+        for owner, ring in list(ns_owners.items()):
+            active = []
+            for r in resources:
+                x = total(ring, now, r)
+                mean, var = ring[f"{r}_mean"], ring[f"{r}_var"]
+                alert = {
+                    "time": end_dt.isoformat(),
+                    "namespace": namespace,
+                    "owner": owner,
+                    "resource": r,
+                    "hours": round(x, 1),
+                    "window": state["window"],
+                }
+
+                if x > thresholds[r]:
+                    active.append(f"quota:{r}")
+                    if f"quota:{r}" not in ring["active"]:
+                        emit({"type": "quota", **alert, "max": thresholds[r]}, hook)
+
+                std = math.sqrt(var)
+                if (
+                    ring["samples"] >= MIN_SAMPLES
+                    and x > 1  # ignore negligible usage
+                    and x > mean + zscore * std
+                ):
+                    active.append(f"anomaly:{r}")
+                    if f"anomaly:{r}" not in ring["active"]:
+                        emit(
+                            {
+                                "type": "anomaly",
+                                **alert,
+                                "usual": round(mean, 1),
+                                "std": round(std, 1),
+                            },
+                            hook,
+                        )
+
+                # Update running mean/variance
+                diff = x - mean
+                ring[f"{r}_mean"] = mean + ALPHA * diff
+                ring[f"{r}_var"] = (1 - ALPHA) * (var + ALPHA * diff**2)
+
+            ring["samples"] += 1
+            ring["active"] = active
+
+            # Forget owners that have been inactive for a while
+            if max(ring["hours"]) < now - 30 * 24:
+                del ns_owners[owner]
+
+    # Check jobs queued for too long (in the last snapshot)
+    _, snapshot = archive.load(end_dt)
+    queued = []
+    for namespace in conf.NAMESPACES:
+        for job in snapshot.get(namespace, []):
+            if job["status"] != "queued":
+                continue
+            hours = (end_dt - submit_dt(job)).total_seconds() / 3600
+            if hours > max_queue_hours:
+                queued.append(job["job_ID"])
+                if job["job_ID"] not in state["queued"]:
+                    alert = {
+                        "type": "queued",
+                        "time": end_dt.isoformat(),
+                        "namespace": namespace,
+                        "owner": job["owner"],
+                        "job_ID": job["job_ID"],
+                        "hours": round(hours, 1),
+                        "max": max_queue_hours,
+                    }
+                    emit(alert, hook)
+    state["queued"] = queued  # only jobs still queued are kept
+
+    state["last_snapshot"] = end_dt.isoformat()
+    with open(state_pth, "w") as f:
+        json.dump(state, f)
+
+
+if __name__ == "__main__":
+    typer.run(main)
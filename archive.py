@@ -0,0 +1,579 @@
+"""
+Read snapshots from the archive, and delta-encode them.
+
+Snapshots can either be stored as full files (`snapshots/*.ndjson`, one job record per
+line, or `snapshots/*.json` for older snapshots) or delta-encoded
+(`deltas/YYYY-MM-DD.ndjson`). Delta files store one keyframe (full snapshot) per day,
+followed by the diffs of the rest of the snapshots of that day (added, removed and
+changed jobs, by `job_ID`). Snapshots encoded after later ones of their day are stored
+in their own delta file (`deltas/<snapshot name>.ndjson`). Old months can be compacted
+into a single compressed delta file (`deltas/YYYY-MM.ndjson.gz`, one keyframe per
+month). Readers handle all formats transparently.
+
+Delta-encode the new snapshots (optionally deleting the full files afterwards):
+    python archive.py encode [--delete]
+
+Compact the months older than 60 days (deleting their full and daily delta files):
+    python archive.py compact --keep-days 60
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import fcntl
+import gzip
+import json
+import os
+from pathlib import Path
+import sys
+
+import typer
+
+from records import Job, Record
+
+
+main_dir = Path(__file__).resolve().parent
+snapshot_dir = main_dir / "snapshots"
+delta_dir = main_dir / "deltas"
+index_pth = delta_dir / "index.json"
+lock_pth = snapshot_dir / ".lock"
+
+app = typer.Typer()
+
+
+@app.callback()
+def callback():
+    """
+    Manage the snapshot archive.
+    """
+
+
+def parse_stem(
+    stem: str,
+):
+    """
+    Parse the datetime of a snapshot from its name.
+    """
+    return datetime.strptime(stem, "%Y-%m-%dT%H:%M:%S")
+
+
+def load_index():
+    """
+    Load the index of delta-encoded snapshots ({snapshot name: delta file name}).
+    Delta files are named after their day, or month for compacted files.
+    """
+    if not index_pth.exists():
+        return {}
+    with open(index_pth, "r") as f:
+        return json.load(f)
+
+
+def save_index(
+    index: dict,
+):
+    """
+    Save the index of delta-encoded snapshots (atomically).
+    """
+    tmp_pth = index_pth.with_suffix(".tmp")
+    with open(tmp_pth, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_pth, index_pth)
+
+
+def delta_path(
+    name: str,
+):
+    """
+    Path of a delta file, either compressed (compacted months) or not.
+    """
+    pth = delta_dir / f"{name}.ndjson.gz"
+    if pth.exists():
+        return pth
+    return delta_dir / f"{name}.ndjson"
+
+
+def open_delta(
+    name: str,
+):
+    """
+    Open a delta file for reading, either compressed (compacted months) or not.
+    """
+    pth = delta_path(name)
+    if pth.suffix == ".gz":
+        return gzip.open(pth, "rt")
+    return open(pth, "r")
+
+
+@contextmanager
+def locked():
+    """
+    Hold the archive lock, so that the processes that modify the archive files
+    (encoding, compaction and normalization) do not run at the same time. Readers do
+    not need it, as files are always replaced atomically.
+    """
+    with open(lock_pth, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def snapshot_files():
+    """
+    List the full snapshot files (skipping partial snapshots still being written).
+    """
+    return [
+        p
+        for p in snapshot_dir.glob("**/*")
+        if p.suffix in [".json", ".ndjson"]
+        and not any(d.startswith(".") for d in p.relative_to(snapshot_dir).parts)
+    ]
+
+
+def list_snapshots():
+    """
+    List all the snapshots in the archive, sorted by date.
+
+    Returns a list of `(datetime, source)` tuples, where source is either the path of
+    the full snapshot or the name of the delta file. If a snapshot is stored in both
+    formats, the delta is preferred (faster to read).
+    """
+    snapshots = {p.stem: p for p in snapshot_files()}
+    snapshots.update(load_index())
+    return [(parse_stem(k), snapshots[k]) for k in sorted(snapshots.keys())]
+
+
+def check_meta(
+    name: str,
+    meta: dict,
+):
+    """
+    Warn about incomplete snapshots (some jobs could not be retrieved).
+    """
+    if not meta.get("complete", True):
+        print(f"Warning: snapshot {name} is incomplete ({len(meta['failed'])} failed)")
+
+
+def read_full(
+    pth: Path,
+):
+    """
+    Read a full snapshot file. NDJSON snapshots are parsed one record at a time, so
+    only the parsed jobs are kept in memory.
+
+    Returns the jobs of each namespace indexed by job ID, and the snapshot metadata
+    (whether it is complete, failed jobs, etc.).
+    """
+    if pth.suffix == ".json":
+        with open(pth, "r") as f:
+            snapshot = json.load(f)
+        meta = snapshot.pop("_meta", {})
+        new = {
+            sys.intern(ns): {j["job_ID"]: Job.from_dict(j) for j in jobs}
+            for ns, jobs in snapshot.items()
+        }
+    else:
+        new, meta = {}, {}
+        with open(pth, "r") as f:
+            for line in f:
+                job = json.loads(line)
+                if "_meta" in job:
+                    meta = job["_meta"]
+                    continue
+                ns = sys.intern(job.pop("namespace"))
+                new.setdefault(ns, {})[job["job_ID"]] = Job.from_dict(job)
+    check_meta(pth.stem, meta)
+    return new, meta
+
+
+def make_diff(
+    old: dict,
+    new: dict,
+):
+    """
+    Compute the diff between two snapshots (jobs of each namespace indexed by job ID).
+    If `old` is None, returns a keyframe with all the jobs of `new`.
+    """
+    if old is None:
+        return {
+            "reset": True,
+            "added": {ns: list(jobs.values()) for ns, jobs in new.items()},
+            "changed": {},
+            "removed": {},
+        }
+
+    diff = {"reset": False, "added": {}, "changed": {}, "removed": {}}
+    for ns in old.keys() | new.keys():
+        o, n = old.get(ns, {}), new.get(ns, {})
+        added = [n[k] for k in n.keys() - o.keys()]
+        changed = [n[k] for k in n.keys() & o.keys() if n[k] != o[k]]
+        removed = list(o.keys() - n.keys())
+        if added:
+            diff["added"][ns] = added
+        if changed:
+            diff["changed"][ns] = changed
+        if removed:
+            diff["removed"][ns] = removed
+    return diff
+
+
+def apply_diff(
+    state: dict,
+    diff: dict,
+):
+    """
+    Apply a diff to a snapshot (jobs of each namespace indexed by job ID), in place.
+    """
+    if diff["reset"]:
+        state.clear()
+    for key in ["added", "changed"]:
+        for ns, jobs in diff[key].items():
+            ns_state = state.setdefault(sys.intern(ns), {})
+            for j in jobs:
+                ns_state[j["job_ID"]] = Job.from_dict(j)
+    for ns, job_IDs in diff["removed"].items():
+        for k in job_IDs:
+            state[ns].pop(k, None)
+    return state
+
+
+def peek(
+    line: str,
+):
+    """
+    Parse the header of a delta line (snapshot name and whether it is a keyframe),
+    without parsing its jobs.
+
+    Delta lines are written with the header first, so only the part before the jobs
+    is parsed. Lines with other key orders (or formatting) are parsed in full.
+    """
+    try:
+        head = json.loads(line[: line.index(', "added": ')] + "}")
+    except ValueError:
+        head = {}
+    if "snapshot" not in head or "reset" not in head:
+        head = json.loads(line)
+    return head["snapshot"], head["reset"]
+
+
+def iter_diffs(
+    ini_dt: datetime = None,
+    end_dt: datetime = None,
+):
+    """
+    Iterate over the snapshots in the [ini_dt, end_dt] range (both optional), as diffs.
+
+    Yields tuples `(datetime, diff, state)`, where `state` is the full snapshot (jobs
+    of each namespace indexed by job ID) after applying the diff. The first diff is
+    always a keyframe (`diff["reset"]` is True). The snapshot metadata (eg. datacenter
+    capacity) is in `diff["meta"]`. `state` is updated in place, so make a copy if you
+    need to keep it between iterations.
+    """
+    snapshots = list_snapshots()
+    if ini_dt:
+        # Start from the last snapshot at or before ini_dt, earlier files are not read
+        # (full snapshots and delta files are self-contained, from their keyframes)
+        first = [i for i, (dt, _) in enumerate(snapshots) if dt <= ini_dt]
+        snapshots = snapshots[first[-1] if first else 0 :]
+
+    state = None
+    started = False
+    day, lines = None, None
+
+    for dt, src in snapshots:
+        if end_dt and dt > end_dt:
+            break
+        before = ini_dt and dt < ini_dt
+
+        if isinstance(src, Path):
+            if lines:
+                lines.close()  # the next delta snapshot is rebuilt from its keyframe
+            day, lines = None, None
+            if before:
+                state = None
+                continue
+            new, meta = read_full(src)
+            diff = make_diff(state, new)
+            state = new
+
+        elif src != day:
+            # Open the delta file, and rebuild the snapshot from the last keyframe
+            # before it (earlier lines are skipped without parsing their jobs)
+            if lines:
+                lines.close()
+            day = src
+            lines = open_delta(day)
+            todo = []
+            for line in lines:
+                name, reset = peek(line)
+                if reset:
+                    todo = []
+                todo.append(line)
+                if name == dt.isoformat():
+                    break
+            new = {}
+            for line in todo:
+                diff = json.loads(line)
+                apply_diff(new, diff)
+            meta = diff.get("meta", {})
+            check_meta(name, meta)
+            diff = make_diff(state, new)
+            state = new
+
+        else:
+            # Delta files are read sequentially
+            for line in lines:
+                diff = json.loads(line)
+                name = diff.pop("snapshot")
+                meta = diff.pop("meta", {})
+                if diff["reset"]:
+                    # Convert keyframes to proper diffs
+                    new = apply_diff({}, diff)
+                    diff = make_diff(state, new)
+                    state = new
+                else:
+                    state = apply_diff(state, diff)
+                if name == dt.isoformat():
+                    check_meta(name, meta)
+                    break
+
+        if before:
+            continue
+        if not started:
+            diff = make_diff(None, state)
+            started = True
+
+        diff["meta"] = meta
+        yield dt, diff, state
+
+    if lines:
+        lines.close()
+
+
+def iter_snapshots(
+    ini_dt: datetime = None,
+    end_dt: datetime = None,
+):
+    """
+    Iterate over the snapshots in the [ini_dt, end_dt] range (both optional).
+
+    Yields tuples `(datetime, snapshot)`, with snapshots in the same format as saved by
+    `take_snapshot.py` (list of jobs of each namespace).
+    """
+    for dt, _, state in iter_diffs(ini_dt, end_dt):
+        yield dt, {ns: list(jobs.values()) for ns, jobs in state.items()}
+
+
+def iter_records(
+    ini_dt: datetime = None,
+    end_dt: datetime = None,
+):
+    """
+    Iterate over the job records of the snapshots in the [ini_dt, end_dt] range (both
+    optional), one record at a time. Full NDJSON snapshots are streamed, so they are
+    never loaded in memory, while delta snapshots are read as diffs (`iter_diffs`).
+
+    Yields tuples `(datetime, namespace, job)`. As in NDJSON snapshots, the last tuple
+    of each snapshot is `(datetime, "_meta", meta)`, with the snapshot metadata.
+    """
+    snapshots = [
+        (dt, src)
+        for dt, src in list_snapshots()
+        if (not ini_dt or dt >= ini_dt) and (not end_dt or dt <= end_dt)
+    ]
+    streamed = [
+        isinstance(src, Path) and src.suffix == ".ndjson" for _, src in snapshots
+    ]
+
+    i = 0
+    while i < len(snapshots):
+        dt, src = snapshots[i]
+        if streamed[i]:
+            meta = {}
+            with open(src, "r") as f:
+                for line in f:
+                    job = json.loads(line)
+                    if "_meta" in job:
+                        meta = job["_meta"]
+                        continue
+                    ns = sys.intern(job.pop("namespace"))
+                    yield dt, ns, Job.from_dict(job)
+            check_meta(src.stem, meta)
+            yield dt, "_meta", meta
+            i += 1
+            continue
+
+        # Read the following delta (or legacy JSON) snapshots in a single pass
+        j = i
+        while j < len(snapshots) and not streamed[j]:
+            j += 1
+        for dt, diff, state in iter_diffs(dt, snapshots[j - 1][0]):
+            for ns, jobs in state.items():
+                for job in jobs.values():
+                    yield dt, ns, job
+            yield dt, "_meta", diff["meta"]
+        i = j
+
+
+def load(
+    dt: datetime,
+):
+    """
+    Load the last snapshot taken at or before `dt`.
+    Returns a tuple `(datetime, snapshot)`.
+    """
+    dts = [d for d, _ in list_snapshots() if d <= dt]
+    if not dts:
+        raise ValueError(f"No snapshot found before {dt}")
+    return next(iter_snapshots(dts[-1], dts[-1]))
+
+
+@app.command()
+def encode(
+    delete: bool = False,
+):
+    """
+    Delta-encode the full snapshots that are not yet in the delta archive.
+
+    * **delete**: delete the full snapshots once encoded.
+    """
+    with locked():
+        delta_dir.mkdir(exist_ok=True)
+        index = load_index()
+        last = {}  # last snapshot of each delta file
+        for k, v in index.items():
+            last[v] = max(last.get(v, ""), k)
+
+        todo = sorted(
+            (p for p in snapshot_files() if p.stem not in index),
+            key=lambda p: p.stem,
+        )
+        print(f"Encoding {len(todo)} snapshots ...")
+
+        state, day, f = None, None, None
+        for pth in todo:
+            if pth.stem < last.get(pth.stem[:10], ""):
+                # Older than the end of its daily delta file, so it is stored in its
+                # own delta file (as a keyframe), as delta files are read in order
+                print(f"  Storing {pth.stem} apart, older than the end of its day")
+                new, meta = read_full(pth)
+                diff = make_diff(None, new)
+                if meta:
+                    diff["meta"] = meta  # keep track of incomplete snapshots
+                line = {"snapshot": pth.stem, **diff}
+                with open(delta_dir / f"{pth.stem}.ndjson", "w") as g:
+                    g.write(json.dumps(line, default=Record.to_dict) + "\n")
+                index[pth.stem] = pth.stem
+                continue
+
+            # Start a new delta file each day, or resume the current one
+            if pth.stem[:10] != day:
+                if f:
+                    f.close()
+                day = pth.stem[:10]
+                state = None
+                if (delta_dir / f"{day}.ndjson").exists():
+                    with open(delta_dir / f"{day}.ndjson", "r") as g:
+                        state = {}
+                        for line in g:
+                            apply_diff(state, json.loads(line))
+                f = open(delta_dir / f"{day}.ndjson", "a")
+
+            new, meta = read_full(pth)
+            diff = make_diff(state, new)
+            if meta:
+                diff["meta"] = meta  # keep track of incomplete snapshots
+            line = {"snapshot": pth.stem, **diff}
+            f.write(json.dumps(line, default=Record.to_dict) + "\n")
+            state = new
+            index[pth.stem] = day
+            last[day] = pth.stem
+
+        if f:
+            f.close()
+        save_index(index)
+
+        if delete:
+            for pth in snapshot_files():
+                if pth.stem in index:
+                    pth.unlink()
+
+
+@app.command()
+def compact(
+    keep_days: int = 60,
+):
+    """
+    Compact the months older than `keep_days` into compressed delta files (one
+    keyframe per month), and delete their full snapshots and daily delta files.
+
+    Compaction is lossless (all the snapshots are kept), so reports give the same
+    results. Each month is read back and compared with the original snapshots before
+    deleting them.
+
+    * **keep_days**: recent snapshots are kept as they are (full files or daily delta
+      files), only whole months older than this are compacted.
+    """
+    with locked():
+        delta_dir.mkdir(exist_ok=True)
+        cutoff = datetime.utcnow() - timedelta(days=keep_days)
+        index = load_index()
+
+        months = {}
+        for dt, src in list_snapshots():
+            months.setdefault(dt.strftime("%Y-%m"), []).append((dt, src))
+        for month, snapshots in months.items():
+            next_month = datetime.strptime(month, "%Y-%m") + timedelta(days=32)
+            next_month = next_month.replace(day=1)
+            if next_month > cutoff:
+                continue  # month not old enough
+            if all(src == month for _, src in snapshots):
+                continue  # already compacted
+
+            print(f"Compacting {len(snapshots)} snapshots of {month} ...")
+            ini_dt, end_dt = snapshots[0][0], snapshots[-1][0]
+            pth = delta_dir / f"{month}.ndjson.gz"
+            tmp_pth = delta_dir / f".{month}.ndjson.gz.tmp"
+            with gzip.open(tmp_pth, "wt") as f:
+                for dt, diff, _ in iter_diffs(ini_dt, end_dt):
+                    meta = diff.pop("meta")
+                    if meta:
+                        diff["meta"] = meta  # keep track of incomplete snapshots
+                    line = {"snapshot": dt.isoformat(), **diff}
+                    f.write(json.dumps(line, default=Record.to_dict) + "\n")
+
+            # Check that the compacted month has the same snapshots (ignoring empty
+            # namespaces, that readers treat as missing)
+            with gzip.open(tmp_pth, "rt") as f:
+                state, n, same = {}, 0, True
+                for (dt, _, original), line in zip(iter_diffs(ini_dt, end_dt), f):
+                    diff = json.loads(line)
+                    apply_diff(state, diff)
+                    n += 1
+                    same = diff["snapshot"] == dt.isoformat() and {
+                        ns: jobs for ns, jobs in state.items() if jobs
+                    } == {ns: jobs for ns, jobs in original.items() if jobs}
+                    if not same:
+                        break
+            if not same or n != len(snapshots):
+                tmp_pth.unlink()
+                raise RuntimeError(f"Compacted snapshots of {month} differ, aborting")
+            os.replace(tmp_pth, pth)
+
+            # Switch readers to the compacted file, then delete the original files
+            sources = {src for _, src in snapshots}
+            for dt, _ in snapshots:
+                index[dt.isoformat()] = month
+            save_index(index)
+            for src in sources:
+                if isinstance(src, Path):
+                    src.unlink()
+                elif src != month:
+                    (delta_dir / f"{src}.ndjson").unlink()
+            for p in snapshot_files():  # full files also stored as daily deltas
+                if p.stem in index and index[p.stem] == month:
+                    p.unlink()
+
+
+if __name__ == "__main__":
+    app()
@@ -1,7 +1,30 @@
 """
 Common configuration for all files.
+
+By default, a single Nomad cluster is used, configured with the standard `NOMAD_*`
+environment variables. To collect a federation of clusters, list them in
+`clusters.json` (or in the file pointed by `ACCOUNTING_CLUSTERS`):
+[
+    {
+        "name": "ifca",
+        "region": "global",
+        "address": "https://193.146.75.205:4646",
+        "cacert": "/home/ubuntu/nomad-certs/nomad-federated/nomad-ca.pem",
+        "cert": "/home/ubuntu/nomad-certs/nomad-federated/cli.pem",
+        "key": "/home/ubuntu/nomad-certs/nomad-federated/cli-key.pem",
+        "concurrency": 4
+    },
+    ...
+]
+
+Server certificates are verified against `cacert` (or the system CAs, if missing).
+`cert` and `key` are the client certificate and its key, only used if both are set.
 """
 
+import json
+import os
+from pathlib import Path
+
 import nomad
 
 # Disable insecure requests warning
@@ -10,8 +33,80 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
-# Automatically retrieve all namespaces from Nomad
 Nomad = nomad.Nomad()
-NAMESPACES = [n["Name"] for n in Nomad.namespaces.get_namespaces()]
-NAMESPACES.remove("default")
-NAMESPACES.remove("tutorials")
+
+main_dir = Path(__file__).resolve().parent
+clusters_pth = Path(os.environ.get("ACCOUNTING_CLUSTERS", main_dir / "clusters.json"))
+
+
+def load_clusters():
+    """
+    Load the configs of the Nomad clusters to collect.
+
+    Returns a list of dicts with the cluster `name`, `region`, `concurrency` (max
+    number of simultaneous requests to the cluster) and Nomad `client`.
+    """
+    if not clusters_pth.exists():
+        return [
+            {
+                "name": os.environ.get("NOMAD_CLUSTER", "default"),
+                "region": os.environ.get("NOMAD_REGION", "global"),
+                "concurrency": 4,
+                "client": Nomad,
+            }
+        ]
+
+    with open(clusters_pth, "r") as f:
+        configs = json.load(f)
+    clusters = []
+    for c in configs:
+        # Verify the server certificate (against `cacert`, if given), and only use a
+        # client certificate if both the certificate and its key are given
+        cert = (c["cert"], c["key"]) if c.get("cert") and c.get("key") else ()
+        client = nomad.Nomad(
+            address=c["address"],
+            region=c.get("region"),
+            token=c.get("token"),
+            verify=c.get("cacert", True),
+            cert=cert,
+        )
+        clusters.append(
+            {
+                "name": c["name"],
+                "region": c.get("region", "global"),
+                "concurrency": c.get("concurrency", 4),
+                "client": client,
+            }
+        )
+    return clusters
+
+
+def get_namespaces(
+    cluster: dict,
+):
+    """
+    Retrieve the namespaces of a cluster (cached in the cluster config).
+    """
+    if "namespaces" not in cluster:
+        namespaces = [n["Name"] for n in cluster["client"].namespaces.get_namespaces()]
+        cluster["namespaces"] = [
+            n for n in namespaces if n not in ["default", "tutorials"]
+        ]
+    return cluster["namespaces"]
+
+
+def __getattr__(name):
+    # Clusters and namespaces are loaded lazily (on first access) so that offline
+    # scripts that import this module (eg. merging stats) do not need a live
+    # connection to the cluster.
+    if name == "CLUSTERS":
+        globals()["CLUSTERS"] = load_clusters()  # cache for next accesses
+        return globals()["CLUSTERS"]
+    if name == "NAMESPACES":
+        # Automatically retrieve all namespaces from Nomad (all clusters)
+        namespaces = []
+        for c in __getattr__("CLUSTERS"):
+            namespaces += [n for n in get_namespaces(c) if n not in namespaces]
+        globals()["NAMESPACES"] = namespaces  # cache for next accesses
+        return namespaces
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,245 @@
+"""
+Pre-aggregated rollup cube for ad-hoc accounting queries.
+
+The cube stores the exact resource-seconds consumed per
+(time bucket, namespace, owner, cluster, region, datacenter, docker_image), computed
+with the same logic as `usage_stats`. It is updated incrementally as new snapshots
+arrive, so queries never need to re-read the snapshots.
+
+Totals for a date range can slightly differ from `usage_stats`, because the cube splits
+the usage between two snapshots over the exact hours it happened, while `usage_stats`
+clips it to the first/last snapshot inside the range.
+
+Update the cube with the new snapshots:
+    python cube.py build
+
+Query it:
+    python cube.py query --group-by namespace --group-by month --resource gpu_num
+    python cube.py query --group-by owner --filter namespace=vo.ai4eosc.eu
+"""
+
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+import time
+
+import pandas as pd
+import rich.console
+import rich.table
+import typer
+
+import archive
+import conf
+from usage_stats import iter_usage
+
+
+main_dir = Path(__file__).resolve().parent
+summary_dir = main_dir / "summaries"
+cube_pth = summary_dir / "cube.pkl"
+state_pth = summary_dir / "cube.json"
+
+resources = [
+    "cpu_num",
+    "cpu_MHz",
+    "memory_MB",
+    "disk_MB",
+    "gpu_num",
+]
+dimensions = [
+    "namespace",
+    "owner",
+    "cluster",
+    "region",
+    "datacenter",
+    "docker_image",
+]
+periods = {  # time groupings available in queries
+    "hour": "h",
+    "day": "D",
+    "month": "M",
+    "quarter": "Q",
+    "year": "Y",
+}
+
+app = typer.Typer()
+
+
+def split(
+    start: datetime,
+    end: datetime,
+    freq: str,
+):
+    """
+    Split the [start, end] interval in hour/day buckets.
+    Yields tuples `(bucket, seconds)`.
+    """
+    if freq == "hour":
+        bucket = start.replace(minute=0, second=0, microsecond=0)
+        step = timedelta(hours=1)
+    else:
+        bucket = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        step = timedelta(days=1)
+
+    while bucket < end:
+        seconds = (min(end, bucket + step) - max(start, bucket)).total_seconds()
+        yield bucket, seconds
+        bucket += step
+
+
+@app.command()
+def build(
+    freq: str = "hour",
+    rebuild: bool = False,
+):
+    """
+    Add the new snapshots to the cube (or rebuild it from scratch).
+
+    * **freq**: time resolution of the cube (`hour` or `day`), only used when the cube
+      is created.
+    """
+    snapshot_dts = [dt for dt, _ in archive.list_snapshots()]
+
+    if state_pth.exists() and cube_pth.exists() and not rebuild:
+        with open(state_pth, "r") as f:
+            state = json.load(f)
+        cube = pd.read_pickle(cube_pth)
+        for d in dimensions:
+            if d not in cube.columns:  # cubes created before adding the dimension
+                cube[d] = ""
+        prev_snapshot_dt = datetime.fromisoformat(state["last_snapshot"])
+        ini_dt = prev_snapshot_dt + timedelta(seconds=1)
+    else:
+        if freq not in ["hour", "day"]:
+            raise typer.BadParameter("Cube frequency must be either `hour` or `day`")
+        state = {"freq": freq}
+        cube = None
+        prev_snapshot_dt = None
+        ini_dt = snapshot_dts[0]
+    end_dt = snapshot_dts[-1]
+
+    if cube is not None and end_dt < ini_dt:
+        print("Cube is already up to date")
+        return
+
+    print(f"Adding snapshots for the period {ini_dt}:{end_dt} to the cube ...")
+
+    # Accumulate resource-seconds in a dict for fast updates
+    rows = {}
+    for namespace, job, start, end in iter_usage(
+        ini_dt=ini_dt,
+        end_dt=end_dt,
+        namespaces=conf.NAMESPACES,
+        prev_snapshot_dt=prev_snapshot_dt,
+    ):
+        for bucket, seconds in split(start, end, state["freq"]):
+            k = (
+                bucket,
+                namespace,
+                job["owner"],
+                job.get("cluster") or "",
+                job.get("region") or "",
+                job.get("datacenter") or "",
+                job.get("docker_image") or "",
+            )
+            acc = rows.setdefault(k, [0.0] * len(resources))
+            for i, r in enumerate(resources):
+                acc[i] += job["resources"][r] * seconds
+
+    new = pd.DataFrame(
+        [k + tuple(v) for k, v in rows.items()],
+        columns=["time"] + dimensions + resources,
+    )
+    if cube is not None:
+        new = pd.concat([cube.astype({d: str for d in dimensions}), new])
+
+    # Consolidate buckets shared by old and new snapshots
+    cube = new.groupby(["time"] + dimensions, as_index=False, observed=True).sum()
+    cube["time"] = pd.to_datetime(cube["time"])
+    cube = cube.astype({d: "category" for d in dimensions})
+
+    cube.to_pickle(cube_pth)
+    state["last_snapshot"] = end_dt.isoformat()
+    with open(state_pth, "w") as f:
+        json.dump(state, f, indent=2)
+
+    print(f"Cube has {len(cube)} rows")
+
+
+@app.command()
+def query(
+    group_by: list[str] = typer.Option([], help=f"{dimensions + list(periods)}"),
+    filter: list[str] = typer.Option([], help="eg. namespace=vo.ai4eosc.eu"),
+    resource: list[str] = typer.Option([], help=f"{resources}"),
+    ini_date: str = None,
+    end_date: str = None,
+    csv: Path = None,
+):
+    """
+    Answer a group-by/filter query from the cube (results in resource-hours).
+    """
+    t0 = time.perf_counter()
+
+    cube = pd.read_pickle(cube_pth)
+    with open(state_pth, "r") as f:
+        state = json.load(f)
+
+    # Filter dates (both included)
+    mask = pd.Series(True, index=cube.index)
+    if ini_date:
+        mask &= cube["time"] >= datetime.strptime(ini_date, "%Y-%m-%d")
+    if end_date:
+        mask &= cube["time"] < datetime.strptime(end_date, "%Y-%m-%d") + timedelta(
+            days=1
+        )
+
+    # Filter dimensions
+    for f in filter:
+        k, v = f.split("=", 1)
+        if k not in dimensions:
+            raise typer.BadParameter(f"Unknown filter dimension: {k}")
+        mask &= cube[k] == v
+    df = cube[mask]
+
+    # Group
+    keys = []
+    for g in group_by:
+        if g in dimensions:
+            keys.append(df[g])
+        elif g in periods:
+            if g == "hour" and state["freq"] != "hour":
+                raise typer.BadParameter("Cube does not have hourly resolution")
+            keys.append(df["time"].dt.to_period(periods[g]).astype(str).rename(g))
+        else:
+            raise typer.BadParameter(f"Unknown group-by dimension: {g}")
+
+    res = resource or resources
+    if keys:
+        out = df.groupby(keys, observed=True)[res].sum().reset_index()
+    else:
+        out = df[res].sum().to_frame().T
+    out[res] = (out[res] / 3600).astype(int)  # resource-seconds to hours
+    out = out.rename(columns={r: f"{r} hours" for r in res})
+
+    elapsed = (time.perf_counter() - t0) * 1000
+
+    if csv:
+        out.to_csv(csv, sep=";", index=False)
+
+    # Print pretty report
+    console = rich.console.Console()
+    table = rich.table.Table(
+        title=f"Accounting query ({len(out)} rows, {elapsed:.0f} ms)",
+    )
+    for c in out.columns:
+        table.add_column(
+            str(c),
+            justify="right",
+            style="pink1" if c.endswith(" hours") else "cyan",
+        )
+    for row in out.itertuples(index=False):
+        table.add_row(*[str(v) for v in row])
+    console.print(table, soft_wrap=True)
+
+
+if __name__ == "__main__":
+    app()
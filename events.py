@@ -0,0 +1,460 @@
+"""
+Append-only log of allocation start/stop transitions, and exact accounting based on it.
+
+Events are saved as one JSON record per line, in one file per month
+(`events/YYYY-MM.ndjson`, based on the time of the transition). They are either
+recorded live (`take_snapshot.py --daemon`) or derived from the differences between
+consecutive snapshots:
+    python events.py build
+
+Accounting reports use the exact allocation start/stop times, and only read the events
+of the requested period (plus a checkpoint of the allocations that were already
+running when the period started):
+    python events.py report --ini-date 2024-09-01 --end-date 2025-02-28
+"""
+
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+import sys
+
+import rich.console
+import rich.table
+import typer
+
+import archive
+import conf
+from usage_stats import dimensions, parse_time
+
+
+main_dir = Path(__file__).resolve().parent
+event_dir = main_dir / "events"
+checkpoint_dir = event_dir / "checkpoints"
+state_pth = event_dir / "state.json"
+
+# Nomad uses the zero time for tasks that have not started/finished yet
+ZERO_TIME = "0001-01-01T00:00:00Z"
+
+
+app = typer.Typer()
+
+
+def format_time(
+    dt: datetime,
+):
+    """
+    Format a datetime like Nomad allocation times.
+    """
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f") + "000Z"
+
+
+def is_set(
+    t: str,
+):
+    """
+    Whether an allocation time has been set.
+    """
+    return bool(t) and t != ZERO_TIME
+
+
+def make_event(
+    type_: str,
+    time: str,
+    namespace: str,
+    job: dict,
+    alloc_ID: str,
+    **kwargs,
+):
+    """
+    Create a transition event for a job record.
+    """
+    return {
+        "time": time,
+        "type": type_,
+        "namespace": namespace,
+        "job_ID": job["job_ID"],
+        "alloc_ID": alloc_ID,
+        "owner": job["owner"],
+        "cluster": job.get("cluster"),
+        "region": job.get("region"),
+        "datacenter": job.get("datacenter"),
+        "docker_image": job.get("docker_image"),
+        "resources": dict(job["resources"]),
+        **kwargs,
+    }
+
+
+def transitions(
+    namespace: str,
+    old: dict,
+    new: dict,
+):
+    """
+    Compute the allocation transitions between two versions of the same job record
+    (`old` is None if the job was not known before).
+
+    Returns a list of events.
+    """
+    events = []
+    old = old or {}
+
+    new_alloc = new.get("alloc_ID")
+    old_alloc = old.get("alloc_ID")
+
+    # The previous allocation was replaced before we saw it finishing
+    # (eg. rescheduled after a node failure): close it when the new one starts
+    if (
+        old_alloc
+        and old_alloc != new_alloc
+        and is_set(old.get("alloc_start"))
+        and not is_set(old.get("alloc_end"))
+        and is_set(new.get("alloc_start"))
+    ):
+        events.append(
+            make_event(
+                "stop",
+                new["alloc_start"],
+                namespace,
+                old,
+                old_alloc,
+                inferred=True,
+            )
+        )
+
+    if not new_alloc or not is_set(new.get("alloc_start")):
+        return events
+
+    # Allocation started
+    if old_alloc != new_alloc or not is_set(old.get("alloc_start")):
+        events.append(
+            make_event("start", new["alloc_start"], namespace, new, new_alloc)
+        )
+
+    # Allocation finished
+    finished = new["status"] in ["dead", "complete", "failed"] and is_set(
+        new.get("alloc_end")
+    )
+    old_finished = (
+        old_alloc == new_alloc
+        and old.get("status") in ["dead", "complete", "failed"]
+        and is_set(old.get("alloc_end"))
+    )
+    if finished and not old_finished:
+        events.append(make_event("stop", new["alloc_end"], namespace, new, new_alloc))
+
+    return events
+
+
+def append(
+    events: list,
+):
+    """
+    Append events to the log.
+    """
+    files = {}
+    for e in events:
+        files.setdefault(e["time"][:7], []).append(e)  # YYYY-MM
+
+    for month, month_events in files.items():
+        with open(event_dir / f"{month}.ndjson", "a") as f:
+            for e in month_events:
+                f.write(json.dumps(e) + "\n")
+
+    # Checkpoints of later months are no longer valid
+    if files:
+        first = min(files.keys())
+        for pth in checkpoint_dir.glob("*.json"):
+            if pth.stem > first:
+                pth.unlink()
+
+
+def next_month(
+    month: str,
+):
+    """
+    Return the month (YYYY-MM) following `month`.
+    """
+    dt = datetime.strptime(month, "%Y-%m")
+    return (dt + timedelta(days=32)).strftime("%Y-%m")
+
+
+def read_month(
+    month: str,
+):
+    """
+    Read the events of a month, sorted by time.
+    """
+    pth = event_dir / f"{month}.ndjson"
+    if not pth.exists():
+        return []
+    with open(pth, "r") as f:
+        month_events = [json.loads(line) for line in f]
+    for e in month_events:
+        e["time"] = parse_time(e["time"])
+    # Stops go after starts at the same time, to handle zero-length allocations, but
+    # before the starts of the allocations they reopen
+    return sorted(
+        month_events,
+        key=lambda e: (e["time"], e.get("reopened", False), e["type"] == "stop"),
+    )
+
+
+def replay(
+    open_allocs: dict,
+    e: dict,
+):
+    """
+    Apply an event to the allocations currently open (indexed by alloc ID).
+
+    Returns the closed `(start_event, stop_event)` pair if the event closes an
+    allocation, None otherwise. Duplicated events (eg. recorded both live and from
+    snapshots) are ignored.
+    """
+    if e["type"] == "start":
+        open_allocs.setdefault(e["alloc_ID"], e)
+    elif e["alloc_ID"] in open_allocs:
+        return open_allocs.pop(e["alloc_ID"]), e
+
+
+def checkpoint(
+    month: str,
+):
+    """
+    Return the allocations that were open at the beginning of `month`.
+
+    Checkpoints are computed recursively from the previous month, and cached for past
+    months.
+    """
+    months = sorted(p.stem for p in event_dir.glob("*.ndjson"))
+    if not months or month <= months[0]:
+        return {}
+
+    pth = checkpoint_dir / f"{month}.json"
+    if pth.exists():
+        with open(pth, "r") as f:
+            open_allocs = json.load(f)
+        for e in open_allocs.values():
+            e["time"] = datetime.fromisoformat(e["time"])
+        return open_allocs
+
+    # Find latest cached checkpoint, then replay the months since then
+    prev = month
+    while prev > months[0] and not (checkpoint_dir / f"{prev}.json").exists():
+        prev = (datetime.strptime(prev, "%Y-%m") - timedelta(days=1)).strftime("%Y-%m")
+    open_allocs = checkpoint(prev) if prev != month else {}
+    while prev < month:
+        for e in read_month(prev):
+            replay(open_allocs, e)
+        prev = next_month(prev)
+
+    # Only cache checkpoints of finished months
+    if month < datetime.utcnow().strftime("%Y-%m"):
+        checkpoint_dir.mkdir(exist_ok=True)
+        with open(pth, "w") as f:
+            json.dump(open_allocs, f, default=str)
+
+    return open_allocs
+
+
+def iter_intervals(
+    ini_dt: datetime,
+    end_dt: datetime,
+):
+    """
+    Iterate over the allocations that were running in the [ini_dt, end_dt] range.
+
+    Yields tuples `(event, start, end)`, with the start/end times clipped to the
+    range. Allocations that are still running are counted until `end_dt` (or now).
+    """
+    open_allocs = checkpoint(ini_dt.strftime("%Y-%m"))
+    month = ini_dt.strftime("%Y-%m")
+    while month <= end_dt.strftime("%Y-%m"):
+        for e in read_month(month):
+            if e["time"] > end_dt:
+                break
+            closed = replay(open_allocs, e)
+            if closed:
+                start, stop = closed
+                if stop["time"] > ini_dt:
+                    yield start, max(ini_dt, start["time"]), stop["time"]
+        month = next_month(month)
+
+    end_dt = min(end_dt, datetime.utcnow())
+    for start in open_allocs.values():
+        if start["time"] < end_dt:
+            yield start, max(ini_dt, start["time"]), end_dt
+
+
+@app.command()
+def build():
+    """
+    Add the transitions of the new snapshots to the event log.
+    Allocations of jobs that disappear between snapshots without finishing are closed at
+    the last snapshot they were seen. If they come back later with the same allocation,
+    the allocation is reopened at that time (so only the time between the snapshots is
+    lost).
+    """
+    state = {}
+    if state_pth.exists():
+        with open(state_pth, "r") as f:
+            state = json.load(f)
+
+    # Start from the last processed snapshot, to compare against
+    last_dt = (
+        archive.parse_stem(state["last_snapshot"]) if "last_snapshot" in state else None
+    )
+    namespaces = conf.NAMESPACES
+    gone = state.get("gone", {})  # allocation closed when a job disappeared, by job
+
+    # Only the jobs in the diffs between snapshots need to be processed
+    prev, prev_dt, count = {}, None, 0
+    for snapshot_dt, diff, current in archive.iter_diffs(ini_dt=last_dt):
+        if diff["reset"] and snapshot_dt == last_dt:
+            prev = {n: dict(current.get(n, {})) for n in namespaces}
+            prev_dt = snapshot_dt
+            continue
+        elif diff["reset"]:
+            prev = {n: {} for n in namespaces}
+            diff = archive.make_diff({}, current)  # all jobs are new
+
+        new_events = []
+        for namespace in namespaces:
+            for key in ["added", "changed"]:
+                for job in diff[key].get(namespace, []):
+                    old = prev[namespace].get(job["job_ID"])
+                    k = f"{namespace}/{job['job_ID']}"
+                    alloc_ID, time = gone.pop(k, (None, None))
+                    if old is None and alloc_ID and alloc_ID == job.get("alloc_ID"):
+                        # The job came back with the allocation closed when it
+                        # disappeared, so reopen it
+                        new_events.append(
+                            make_event(
+                                "start",
+                                time,
+                                namespace,
+                                job,
+                                alloc_ID,
+                                inferred=True,
+                                reopened=True,
+                            )
+                        )
+                        old = {
+                            "alloc_ID": alloc_ID,
+                            "alloc_start": job["alloc_start"],
+                            "status": "running",
+                        }
+                    new_events += transitions(namespace, old, job)
+                    prev[namespace][job["job_ID"]] = job
+
+            # Jobs that disappeared without their allocation finishing (whatever their
+            # status, as dead jobs can lack an allocation end)
+            for job_ID in diff["removed"].get(namespace, []):
+                job = prev[namespace].pop(job_ID)
+                if (
+                    job.get("alloc_ID")
+                    and is_set(job.get("alloc_start"))
+                    and not is_set(job.get("alloc_end"))
+                ):
+                    time = format_time(prev_dt)
+                    new_events.append(
+                        make_event(
+                            "stop",
+                            time,
+                            namespace,
+                            job,
+                            job["alloc_ID"],
+                            inferred=True,
+                        )
+                    )
+                    gone[f"{namespace}/{job_ID}"] = (job["alloc_ID"], time)
+
+        append(new_events)
+        prev_dt = snapshot_dt
+        count += 1
+
+    if not count:
+        print("Event log is already up to date")
+        return
+
+    print(f"Added {count} snapshots to the event log")
+    state["last_snapshot"] = prev_dt.isoformat()
+    state["gone"] = gone
+    with open(state_pth, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+@app.command()
+def report(
+    ini_date: str = None,
+    end_date: str = None,
+    group_by: list[str] = None,
+):
+    """
+    Exact accounting report for a given period (both dates included).
+
+    * **group_by**: also split the accounting by these job dimensions
+      (`cluster`, `region`, `datacenter`, `docker_image`).
+    """
+    group_by = group_by or []
+    for d in group_by:
+        if d not in dimensions:
+            raise typer.BadParameter(f"Unknown group-by dimension: {d}")
+
+    months = sorted(p.stem for p in event_dir.glob("*.ndjson"))
+    if not months:
+        print("The event log is empty, run `python events.py build` first")
+        return
+    ini_dt = (
+        datetime.strptime(ini_date, "%Y-%m-%d")
+        if ini_date
+        else datetime.strptime(months[0], "%Y-%m")
+    )
+    end_dt = (
+        datetime.strptime(end_date, "%Y-%m-%d")
+        if end_date
+        else datetime.strptime(next_month(months[-1]), "%Y-%m") - timedelta(days=1)
+    )
+    end_dt = end_dt.replace(
+        hour=23, minute=59, second=59
+    )  # include end_dt in the range
+
+    accounting = {}
+    jobset = {}
+    userset = {}
+    for e, start, end in iter_intervals(ini_dt, end_dt):
+        seconds = (end - start).total_seconds()
+
+        g = (e["namespace"],) + tuple(sys.intern(e.get(d) or "") for d in group_by)
+        acc = accounting.setdefault(g, {})
+        for k, v in e["resources"].items():
+            acc[k] = acc.get(k, 0) + v * seconds
+
+        # Track job and user
+        jobset.setdefault(g, set()).add(e["job_ID"])
+        userset.setdefault(g, set()).add(e["owner"])
+
+    # Print pretty report
+    console = rich.console.Console()
+    table = rich.table.Table(
+        title=f"Accounting for the period {ini_dt.date()}:{end_dt.date()}",
+    )
+    for k in ["namespace"] + group_by:
+        table.add_column(k, style="cyan")
+    resources = list(list(accounting.values())[0].keys()) if accounting else []
+    for k in resources:
+        table.add_column(f"{k} hours", justify="right")
+    table.add_column("Nº jobs", justify="right")
+    table.add_column("Nº active users", justify="right")
+    for g in sorted(accounting.keys()):
+        table.add_row(
+            *g,
+            *[str(int(accounting[g].get(k, 0) / 3600)) for k in resources],
+            str(len(jobset[g])),
+            str(len(userset[g])),
+            style="pink1",
+        )
+    console.print(table, soft_wrap=True)
+
+
+if __name__ == "__main__":
+    app()
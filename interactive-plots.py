@@ -1,13 +1,22 @@
 """
 Interactive plot of stats usage.
+
+Data is written once per namespace as a compact payload (base64 typed arrays) and all
+the charts are rendered client-side with plotly.js from a single shared chart spec.
+Long series are downsampled (LTTB) for the overview, and the full resolution data is
+plotted back when zooming in.
 """
 
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+import base64
+import hashlib
+import json
 from pathlib import Path
 from string import Template
 
+import numpy as np
 import pandas as pd
-import plotly.express as px
+import typer
 
 import conf
 
@@ -15,6 +24,7 @@ import conf
 main_dir = Path.cwd()
 html_dir = main_dir / "htmls"
 summary_dir = main_dir / "summaries"
+cache_pth = html_dir / ".cache.json"
 
 labels = {
     "cpu_num": "CPU cores",
@@ -26,37 +36,185 @@ labels = {
     "queued": "Jobs queued",
 }
 
-# Load html template
-with open(html_dir / "template.html", "r") as f:
-    html_template = Template(f.read())
+# Chart spec shared by all the plots of all the namespaces
+script = Template(
+    """
+<script src="https://cdn.plot.ly/plotly-2.35.2.min.js"></script>
+<script>
+const LABELS = $labels;
+const DATA = $data;
+
+function decode(s) {
+  const bytes = Uint8Array.from(atob(s), (c) => c.charCodeAt(0));
+  return new Int32Array(bytes.buffer);
+}
+
+// Dates are stored as day offsets from the first date
+const t0 = Date.parse(DATA.start);
+const dates = Array.from(decode(DATA.days), (d) => new Date(t0 + d * 864e5));
+
+function trace(x, y) {
+  return {x: x, y: y, type: "scatter", mode: "lines", fill: "tozeroy"};
+}
+
+for (const [k, title] of Object.entries(LABELS)) {
+  const div = document.getElementById("plot-" + k);
+  if (!div) continue;
+
+  const y = decode(DATA.series[k]);
+  const idx = decode(DATA.overview[k]);
+  const layout = {
+    title: title,
+    width: 800,
+    height: 400,
+    xaxis: {title: "Dates"},
+    yaxis: {rangemode: "tozero"},
+  };
+  Plotly.newPlot(div, [trace(Array.from(idx, (i) => dates[i]), Array.from(idx, (i) => y[i]))], layout);
+
+  // Plot full resolution data when zooming in, back to overview when zooming out
+  div.on("plotly_relayout", (e) => {
+    if (e["xaxis.autorange"]) {
+      Plotly.react(div, [trace(Array.from(idx, (i) => dates[i]), Array.from(idx, (i) => y[i]))], div.layout);
+    } else if (e["xaxis.range[0]"]) {
+      const lo = Date.parse(e["xaxis.range[0]"].replace(" ", "T"));
+      const hi = Date.parse(e["xaxis.range[1]"].replace(" ", "T"));
+      const x = [], v = [];
+      dates.forEach((d, i) => {
+        if (lo <= d && d <= hi) { x.push(d); v.push(y[i]); }
+      });
+      Plotly.react(div, [trace(x, v)], div.layout);
+    }
+  });
+}
+</script>
+"""
+)
+
+
+def lttb(
+    y: np.ndarray,
+    n: int,
+):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+    Returns the indices of the `n` points that best preserve the shape of the series.
+    """
+    size = len(y)
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    x = np.arange(size, dtype=float)
+    y = y.astype(float)
+    edges = np.linspace(1, size - 1, n - 1).astype(int)  # buckets exclude first/last
+
+    idx = [0]
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+
+        # Average point of the next bucket
+        nlo, nhi = hi, edges[i + 2] if i + 2 < n - 1 else size
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
 
-# Generate plots
-for namespace in conf.NAMESPACES:
+        # Point of the current bucket forming the largest triangle
+        a = idx[-1]
+        area = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        idx.append(lo + int(area.argmax()))
+    idx.append(size - 1)
+
+    return np.asarray(idx)
+
+
+def encode(a):
+    """
+    Encode an integer array as base64 little-endian Int32 data.
+    """
+    return base64.b64encode(np.asarray(a, dtype="<i4").tobytes()).decode()
+
+
+def build(
+    namespace: str,
+    html_template: str,
+    max_points: int,
+):
+    """
+    Generate the html report of a single namespace.
+    """
     df = pd.read_csv(
         summary_dir / f"{namespace}-timeseries.csv",
         sep=";",
     )
 
+    dates = pd.to_datetime(df["date"])
+    data = {
+        "start": str(dates.iloc[0].date()) if len(dates) else "1970-01-01",
+        "days": encode((dates - dates.min()).dt.days if len(dates) else []),
+        "series": {},
+        "overview": {},
+    }
+    for k in labels.keys():
+        y = df[k].to_numpy() if k in df.columns else np.zeros(len(df), dtype=int)
+        data["series"][k] = encode(y)
+        data["overview"][k] = encode(lttb(y, max_points))
+
+    divs = {k: f'<div id="plot-{k}"></div>' for k in labels.keys()}
+    html = Template(html_template).safe_substitute(divs)  # replace in template
+    js = script.substitute(
+        labels=json.dumps(labels),
+        data=json.dumps(data, separators=(",", ":")),
+    )
+    if "</body>" in html:
+        html = html.replace("</body>", f"{js}</body>", 1)
+    else:
+        html += js
+
     with open(html_dir / f"{namespace}.html", "w") as f:
-        html = deepcopy(html_template)
-        divs = {}
-
-        for k in labels.keys():
-            fig = px.area(
-                x=df["date"],
-                y=df[k],
-                title=labels[k],
-                labels={
-                    "x": "Dates",
-                    # 'y': labels[k],
-                    "y": "",
-                },
-                width=800,
-                height=400,
-            )
-            divs[k] = fig.to_html(  # retrieve html code of the plot
-                full_html=False,
-                include_plotlyjs="cdn",
-            )
-
-        f.write(html.safe_substitute(divs))  # replace in template
+        f.write(html)
+
+
+def main(
+    force: bool = False,
+    max_points: int = 1000,
+    workers: int = None,
+):
+    """
+    * **force**: rebuild all reports, even if their timeseries did not change.
+    * **max_points**: number of points of the downsampled overview of each chart.
+    * **workers**: number of namespaces processed in parallel (default: number of CPUs).
+    """
+    # Load html template
+    with open(html_dir / "template.html", "r") as f:
+        html_template = f.read()
+
+    # Only rebuild namespaces whose timeseries (or the template) changed
+    cache = json.loads(cache_pth.read_text()) if cache_pth.exists() else {}
+    extra = f"{html_template}{script.template}{max_points}".encode()
+    hashes, todo = {}, []
+    for namespace in conf.NAMESPACES:
+        pth = summary_dir / f"{namespace}-timeseries.csv"
+        hashes[namespace] = hashlib.sha256(pth.read_bytes() + extra).hexdigest()
+        if (
+            force
+            or cache.get(namespace) != hashes[namespace]
+            or not (html_dir / f"{namespace}.html").exists()
+        ):
+            todo.append(namespace)
+
+    # Generate plots
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(build, namespace, html_template, max_points): namespace
+            for namespace in todo
+        }
+        for future, namespace in futures.items():
+            future.result()
+            cache[namespace] = hashes[namespace]
+
+    cache_pth.write_text(json.dumps(cache, indent=2))
+    print(f"Generated {len(todo)} reports ({len(hashes) - len(todo)} unchanged)")
+
+
+if __name__ == "__main__":
+    typer.run(main)
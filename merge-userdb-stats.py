@@ -1,33 +1,116 @@
 """
 Merge the users-stats-agg with the user-db info into a single CSV file.
+
+All namespaces are merged in a single pass, using the combined `users-agg.csv`
+generated by `summarize.py`. Optionally, a wide table with one row per user and the
+stats of each namespace side by side can also be generated.
 """
 
 from pathlib import Path
 
 import pandas as pd
-
-import conf
+import typer
 
 
 main_dir = Path(__file__).resolve().parent
 summary_dir = main_dir / "summaries"
-users = pd.read_csv(
-    main_dir / "users" / "user-db.csv",
-    sep=";",
-)
-
-for namespace in conf.NAMESPACES:
-    stats = pd.read_csv(
-        summary_dir / f"{namespace}-users-agg.csv",
-        sep=";",
+
+
+def load_stats():
+    """
+    Load the user aggregates of all namespaces, indexed by (namespace, owner).
+    Returns None if there are no aggregates yet.
+    """
+    pth = summary_dir / "users-agg.csv"
+    if pth.exists():
+        return pd.read_csv(pth, sep=";", index_col="namespace")
+
+    # Fallback to the legacy per-namespace files (summaries generated with older
+    # versions of `summarize.py`)
+    stats = []
+    for pth in sorted(summary_dir.glob("*-users-agg.csv")):
+        df = pd.read_csv(pth, sep=";")
+        df.index = pd.Index(
+            [pth.name.removesuffix("-users-agg.csv")] * len(df), name="namespace"
+        )
+        stats.append(df)
+    if not stats:
+        return None
+    return pd.concat(stats)
+
+
+def merge(
+    stats: pd.DataFrame,
+    users: pd.DataFrame,
+):
+    """
+    Merge user aggregates (indexed by namespace, with an `owner` column) with the user
+    database, in a single join.
+
+    Returns a dataframe with `namespace` and `user id` as columns.
+    """
+    stats = stats.reset_index().rename(columns={"owner": "user id"})
+    stats = stats.rename(
+        columns={
+            k: f"{k} / day" for k in stats.columns if k not in ["namespace", "user id"]
+        }
     )
-    stats = stats.rename(columns={"owner": "user id"})
-    stats = stats.rename(columns={k: f"{k} / day" for k in stats.columns[1:]})
+    return users.merge(stats, on="user id")
 
-    # Merge both dataframes and save
-    final = users.merge(stats, on="user id")
-    final.to_csv(
-        summary_dir / f"{namespace}-users-agg-merged.csv",
+
+def main(
+    from_summary: bool = False,
+    wide: bool = False,
+):
+    """
+    * **from_summary**: compute the user aggregates in memory (running `summarize`)
+      instead of reading them from disk.
+    * **wide**: also save a cross-namespace table, with one row per user.
+    """
+    users = pd.read_csv(
+        main_dir / "users" / "user-db.csv",
         sep=";",
-        index=False,
     )
+
+    if from_summary:
+        import summarize
+
+        stats = summarize.main()
+    else:
+        stats = load_stats()
+        if stats is None:
+            print("No user stats found, run `python summarize.py` first")
+            return
+
+    final = merge(stats, users)
+
+    # Save one file per namespace
+    for namespace, df in final.groupby("namespace", sort=False):
+        df.drop(columns=["namespace"]).to_csv(
+            summary_dir / f"{namespace}-users-agg-merged.csv",
+            sep=";",
+            index=False,
+        )
+
+    # Save cross-namespace table
+    if wide:
+        values = [c for c in final.columns if c.endswith(" / day")]
+        df = final.pivot_table(
+            index="user id",
+            columns="namespace",
+            values=values,
+            aggfunc="sum",
+            fill_value=0,
+        )
+        df = df.swaplevel(axis="columns").sort_index(axis="columns")
+        df.columns = [f"{ns} {k}" for ns, k in df.columns]
+        df = users.merge(df.reset_index(), on="user id")
+        df.to_csv(
+            summary_dir / "users-agg-merged-wide.csv",
+            sep=";",
+            index=False,
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
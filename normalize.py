@@ -0,0 +1,358 @@
+"""
+Normalize the job records of the archive, so that reports do not need to fix them.
+
+Fixes:
+* `cpu_num`: older jobs were misconfigured (CPU MHz was set instead of CPU cores), so
+  their `cpu_num` is 0 and the cores are in `cpu_MHz`,
+* `queued`: running jobs without allocation start are considered queued,
+* `alloc_end`: dead jobs without allocation end are considered to have ended at the
+  first snapshot where they were seen dead. A job seen dead at a snapshot had already
+  ended by then, so this is the tightest bound known at ingestion (the snapshot where
+  the job disappears is not known yet, and archived files are never rewritten
+  afterwards).
+
+The original values of the fixed fields are kept in the `original` field of each
+record, so fixes can be audited. The number of fixes of each snapshot is saved in a
+quality report (`quality/report.csv`).
+
+Snapshots are normalized once, at ingestion (when they are saved by `take_snapshot.py`).
+Reports warn about the snapshots left to normalize, and fix them in memory. The
+snapshots of older archives can be normalized in place (files are processed in
+parallel):
+    python normalize.py [--workers 4]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+import rich.console
+import rich.table
+import typer
+
+import archive
+
+
+main_dir = Path(__file__).resolve().parent
+quality_dir = main_dir / "quality"
+state_pth = quality_dir / "state.json"
+report_pth = quality_dir / "report.csv"
+
+fixes = [
+    "cpu_num",
+    "queued",
+    "alloc_end",
+]
+
+
+def fix_job(
+    job: dict,
+    ends: dict,
+    name: str,
+):
+    """
+    Fix a job record in place, keeping the original values of the fixed fields in
+    `job["original"]`.
+
+    * **ends**: inferred allocation end of the dead jobs without one, by job ID. Jobs
+      that are not there are considered to have ended at this snapshot (and added).
+    * **name**: name of the snapshot of the job.
+
+    Returns the list of fixes applied.
+    """
+    applied = []
+    original = dict(job.get("original") or {})
+    res = job.get("resources") or {}
+    if res.get("cpu_num") == 0 and res.get("cpu_MHz"):
+        original["resources"] = {"cpu_num": res["cpu_num"]}
+        res["cpu_num"] = res["cpu_MHz"]
+        applied.append("cpu_num")
+    if job["status"] == "running" and not job.get("alloc_start"):
+        original["status"] = job["status"]
+        job["status"] = "queued"
+        applied.append("queued")
+    if job["status"] == "dead" and job.get("alloc_start") and not job.get("alloc_end"):
+        original["alloc_end"] = job.get("alloc_end")
+        job["alloc_end"] = ends.setdefault(
+            job["job_ID"], f"{name}.000000000Z"  # Nomad time format
+        )
+        applied.append("alloc_end")
+    if applied:
+        job["original"] = original
+    return applied
+
+
+def new_counts():
+    """
+    Counts of the records of a snapshot, and of each fix applied.
+    """
+    return {"records": 0, **{k: 0 for k in fixes}}
+
+
+def open_file(
+    pth: Path,
+    mode: str = "r",
+    compressed: bool = None,
+):
+    """
+    Open an archive file, either compressed or not (by default, depending on its
+    extension).
+    """
+    if compressed is None:
+        compressed = pth.suffix == ".gz"
+    if compressed:
+        return gzip.open(pth, f"{mode}t")
+    return open(pth, mode)
+
+
+def iter_lines(
+    pth: Path,
+    name: str = None,
+):
+    """
+    Iterate over the contents of an archive file, as `(snapshot name, line, jobs)`,
+    where `jobs` are the job records in the line (that can be fixed in place).
+
+    Legacy JSON snapshots are returned as a single line.
+
+    * **name**: name of the snapshot of a full snapshot file (by default, the name of
+      the file).
+    """
+    name = name or pth.stem
+    if pth.suffix == ".json":
+        with open(pth, "r") as f:
+            snapshot = json.load(f)
+        jobs = [j for ns, js in snapshot.items() if ns != "_meta" for j in js]
+        yield name, snapshot, jobs
+        return
+
+    with open_file(pth) as f:
+        for line in f:
+            line = json.loads(line)
+            if pth.parent == archive.delta_dir:
+                jobs = [
+                    j
+                    for key in ["added", "changed"]
+                    for js in line[key].values()
+                    for j in js
+                ]
+                yield line["snapshot"], line, jobs
+            elif "_meta" in line:
+                yield name, line, []
+            else:
+                yield name, line, [line]
+
+
+def scan(
+    pth: Path,
+):
+    """
+    Find the dead jobs without allocation end in an archive file.
+
+    Returns the name of the first snapshot where each of them was seen, by job ID.
+    """
+    first = {}
+    for name, _, jobs in iter_lines(pth):
+        for job in jobs:
+            if (
+                job["status"] == "dead"
+                and job.get("alloc_start")
+                and not job.get("alloc_end")
+            ):
+                first[job["job_ID"]] = min(first.get(job["job_ID"], name), name)
+    return first
+
+
+def clean(
+    pth: Path,
+    ends: dict,
+    name: str = None,
+):
+    """
+    Fix the job records of an archive file, replacing the file (atomically) if
+    anything was fixed.
+
+    * **name**: name of the snapshot of a full snapshot file (by default, the name of
+      the file).
+
+    Returns the number of records and of each fix applied, by snapshot name.
+    """
+    counts = {}
+    compressed = pth.suffix == ".gz"
+    tmp_pth = pth.with_name(f".{pth.name}.tmp")
+    with open_file(tmp_pth, "w", compressed) as f:
+        for k, line, jobs in iter_lines(pth, name):
+            c = counts.setdefault(k, new_counts())
+            c["records"] += len(jobs)
+            for job in jobs:
+                for fix in fix_job(job, ends, k):
+                    c[fix] += 1
+            if pth.suffix == ".json":
+                json.dump(line, f)
+            else:
+                f.write(json.dumps(line) + "\n")
+
+    if any(c[k] for c in counts.values() for k in fixes):
+        os.replace(tmp_pth, pth)
+    else:
+        tmp_pth.unlink()
+    return counts
+
+
+def load_state():
+    """
+    Load the names of the normalized snapshots, and the inferred allocation end of the
+    dead jobs without one.
+    """
+    state = {}
+    if state_pth.exists():
+        with open(state_pth, "r") as f:
+            state = json.load(f)
+    state.setdefault("snapshots", [])
+    state.setdefault("ends", {})
+    return state
+
+
+def save_state(
+    state: dict,
+    results: dict,
+):
+    """
+    Register the snapshots that were normalized (atomically), and add their fixes to
+    the quality report (one row per snapshot).
+    """
+    quality_dir.mkdir(exist_ok=True)
+    state["snapshots"] = sorted(set(state["snapshots"]) | results.keys())
+    tmp_pth = state_pth.with_suffix(".tmp")
+    with open(tmp_pth, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_pth, state_pth)
+
+    if results:
+        report = pd.DataFrame(
+            [{"snapshot": k, **c} for k, c in sorted(results.items())]
+        )
+        report.to_csv(
+            report_pth,
+            sep=";",
+            index=False,
+            mode="a",
+            header=not report_pth.exists(),
+        )
+
+
+def ingest(
+    pth: Path,
+    name: str,
+):
+    """
+    Normalize a new (NDJSON) snapshot file before adding it to the archive. The file
+    is fixed in place, as no one else is reading it yet.
+    """
+    with archive.locked():
+        state = load_state()
+        results = clean(pth, state["ends"], name)
+        save_state(state, results)
+
+
+def pending():
+    """
+    List the names of the snapshots of the archive that are not normalized yet.
+    """
+    done = set(load_state()["snapshots"])
+    return [
+        dt.isoformat()
+        for dt, _ in archive.list_snapshots()
+        if dt.isoformat() not in done
+    ]
+
+
+def check_archive():
+    """
+    Check that all the snapshots of the archive are normalized, before reading them,
+    warning about the ones that are not (readers fix them in memory, with `fix_job`).
+
+    Returns the names of the snapshots that are not normalized yet.
+    """
+    todo = pending()
+    if todo:
+        print(
+            f"Warning: {len(todo)} snapshots are not normalized yet (eg. {todo[0]}), "
+            "they are fixed in memory (run `python normalize.py` to fix the archive)"
+        )
+    return set(todo)
+
+
+def normalize_archive(
+    workers: int = None,
+):
+    """
+    Normalize the snapshots of the archive that are not normalized yet, fixing their
+    files in place (eg. snapshots taken before normalization was done at ingestion).
+
+    Fixes are idempotent, so the other snapshots of those files are not modified.
+
+    * **workers**: number of files processed in parallel (default: number of CPUs).
+
+    Returns the number of fixes applied, by snapshot name.
+    """
+    with archive.locked():
+        state = load_state()
+        done = set(state["snapshots"])
+        files = set()
+        for dt, src in archive.list_snapshots():
+            if dt.isoformat() not in done:
+                files.add(src if isinstance(src, Path) else archive.delta_path(src))
+        if not files:
+            return {}
+        files = sorted(files)
+        print(f"Normalizing {len(files)} archive files ...")
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Infer the end of the dead jobs without one
+            ends = state["ends"]
+            for first in pool.map(scan, files):
+                for job_ID, name in first.items():
+                    end = f"{name}.000000000Z"  # Nomad time format
+                    ends[job_ID] = min(ends.get(job_ID, end), end)
+
+            # Fix the files
+            results = {}
+            for counts in pool.map(clean, files, [ends] * len(files)):
+                results.update({k: c for k, c in counts.items() if k not in done})
+
+        save_state(state, results)
+    return results
+
+
+def main(
+    workers: int = None,
+):
+    """
+    Normalize the snapshots of the archive that are not normalized yet, and print the
+    fixes applied.
+
+    * **workers**: number of files processed in parallel (default: number of CPUs).
+    """
+    results = normalize_archive(workers)
+    if not results:
+        print("Archive is already normalized")
+        return
+
+    console = rich.console.Console()
+    table = rich.table.Table(title="Records fixed")
+    for k in ["snapshots", "records"] + fixes:
+        table.add_column(k, justify="right", style="pink1")
+    table.add_row(
+        str(len(results)),
+        str(sum(c["records"] for c in results.values())),
+        *[str(sum(c[k] for c in results.values())) for k in fixes],
+    )
+    console.print(table, soft_wrap=True)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,224 @@
+"""
+Queue-time analytics: how long users wait between submitting a job and the start of its
+allocation, per namespace (and optionally GPU request and datacenter).
+
+Wait times are computed in a single pass over the archive, only looking at the jobs that
+changed between snapshots. Per-job wait times are cached per day (of the allocation
+start) in `summaries/queue-times/`, so only new days are processed:
+    python queue_times.py --ini-date 2024-09-01 --end-date 2025-02-28 --group-by gpu_num
+
+Percentiles and histograms are saved to `summaries/queue-times.csv`.
+"""
+
+from datetime import datetime, timedelta, timezone
+import math
+from pathlib import Path
+
+import pandas as pd
+import rich.console
+import rich.table
+import typer
+
+import archive
+from events import is_set
+from usage_stats import parse_time
+
+
+main_dir = Path(__file__).resolve().parent
+summary_dir = main_dir / "summaries"
+cache_dir = summary_dir / "queue-times"
+
+# Job fields that can be used as extra group-by dimensions
+dimensions = [
+    "gpu_num",
+    "datacenter",
+]
+columns = [
+    "job_ID",
+    "namespace",
+    "owner",
+    "gpu_num",
+    "datacenter",
+    "submit",
+    "alloc_start",
+]
+percentiles = [0.5, 0.9, 0.95, 0.99]
+bins = {  # histogram bins (upper edge, in hours)
+    "<1m": 1 / 60,
+    "1-10m": 1 / 6,
+    "10m-1h": 1,
+    "1-6h": 6,
+    "6-24h": 24,
+    ">1d": math.inf,
+}
+
+
+def submit_dt(
+    job: dict,
+):
+    """
+    Submission datetime (UTC) of a job.
+    """
+    if job.get("submit_ts") is not None:
+        return datetime.utcfromtimestamp(job["submit_ts"])
+    # Older snapshots only have the formatted submit time, in the local time of the
+    # host that took the snapshot (`datetime.fromtimestamp`), so convert it to UTC
+    dt = datetime.strptime(job["submit_time"], "%Y-%m-%d %H:%M:%S")
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def update_cache():
+    """
+    Compute the wait times of the days that are not cached yet.
+
+    Days are only cached once there are snapshots of later days (so all the allocations
+    started that day have been seen). Returns the wait times of the days that could not
+    be cached yet.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    snapshot_dts = [dt for dt, _ in archive.list_snapshots()]
+    first_day, last_day = snapshot_dts[0].date(), snapshot_dts[-1].date()
+
+    # Start from the first day missing in the cache
+    day = first_day
+    while day < last_day and (cache_dir / f"{day}.csv").exists():
+        day += timedelta(days=1)
+    ini_dt = datetime(day.year, day.month, day.day)
+
+    # Keep the first allocation start of each job submission
+    rows = {}
+    for _, diff, _ in archive.iter_diffs(ini_dt=ini_dt):
+        for key in ["added", "changed"]:
+            for namespace, jobs in diff[key].items():
+                for job in jobs:
+                    if not is_set(job.get("alloc_start")):
+                        continue
+                    start = parse_time(job["alloc_start"])
+                    if start < ini_dt:
+                        continue  # already cached
+                    k = (job["job_ID"], submit_dt(job))
+                    if k in rows and rows[k][-1] <= start:
+                        continue
+                    rows[k] = (
+                        job["job_ID"],
+                        namespace,
+                        job["owner"],
+                        job["resources"].get("gpu_num", 0),
+                        job.get("datacenter") or "",
+                        k[1],
+                        start,
+                    )
+
+    df = pd.DataFrame(list(rows.values()), columns=columns)
+    df = df.astype({"submit": "datetime64[ns]", "alloc_start": "datetime64[ns]"})
+    days = df["alloc_start"].dt.date
+    while day < last_day:
+        df[days == day].to_csv(cache_dir / f"{day}.csv", sep=";", index=False)
+        day += timedelta(days=1)
+
+    return df[days >= last_day]
+
+
+def load(
+    ini_dt: datetime,
+    end_dt: datetime,
+):
+    """
+    Load the wait times of the jobs whose allocation started in the [ini_dt, end_dt]
+    range.
+    """
+    dfs = [update_cache()]
+    for pth in sorted(cache_dir.glob("*.csv")):
+        if ini_dt.date().isoformat() <= pth.stem <= end_dt.date().isoformat():
+            dfs.append(
+                pd.read_csv(
+                    pth,
+                    sep=";",
+                    parse_dates=["submit", "alloc_start"],
+                    keep_default_na=False,
+                )
+            )
+    df = pd.concat([d for d in dfs if len(d)] or dfs[:1], ignore_index=True)
+    df = df[(df["alloc_start"] >= ini_dt) & (df["alloc_start"] <= end_dt)]
+
+    # A job submission is only counted once (restarts are not queue time)
+    df = df.sort_values("alloc_start").drop_duplicates(["job_ID", "submit"])
+    df["wait_h"] = (df["alloc_start"] - df["submit"]).dt.total_seconds() / 3600
+    df["wait_h"] = df["wait_h"].clip(lower=0)
+    return df
+
+
+def main(
+    ini_date: str = None,
+    end_date: str = None,
+    group_by: list[str] = None,
+):
+    """
+    Wait time distributions (in hours) for a given period (both dates included).
+
+    * **group_by**: also split the distributions by these job dimensions
+      (`gpu_num`, `datacenter`).
+    """
+    group_by = group_by or []
+    for d in group_by:
+        if d not in dimensions:
+            raise typer.BadParameter(f"Unknown group-by dimension: {d}")
+
+    snapshot_list = archive.list_snapshots()
+    ini_dt = (
+        datetime.strptime(ini_date, "%Y-%m-%d") if ini_date else snapshot_list[0][0]
+    )
+    end_dt = (
+        datetime.strptime(end_date, "%Y-%m-%d") if end_date else snapshot_list[-1][0]
+    )
+    ini_dt = ini_dt.replace(hour=0, minute=0, second=0)
+    end_dt = end_dt.replace(
+        hour=23, minute=59, second=59
+    )  # include end_dt in the range
+
+    df = load(ini_dt, end_dt)
+    keys = ["namespace"] + group_by
+    pcols = [f"p{int(p * 100)}" for p in percentiles]
+    if df.empty:
+        # Only save the headers, so that the results of a previous run are not kept
+        pd.DataFrame(
+            columns=keys + ["jobs", "mean"] + pcols + ["max"] + list(bins.keys())
+        ).to_csv(summary_dir / "queue-times.csv", sep=";", index=False)
+        print(f"No jobs were allocated in the period {ini_dt.date()}:{end_dt.date()}")
+        return
+
+    # Percentiles
+    grouped = df.groupby(keys)["wait_h"]
+    stats = grouped.quantile(percentiles).unstack()
+    stats.columns = pcols
+    stats.insert(0, "jobs", grouped.size())
+    stats.insert(1, "mean", grouped.mean())
+    stats["max"] = grouped.max()
+    stats = stats.round(2)
+
+    # Histograms
+    edges = [-math.inf] + list(bins.values())
+    df["bin"] = pd.cut(df["wait_h"], bins=edges, labels=list(bins.keys()))
+    hist = df.groupby(keys + ["bin"], observed=False).size().unstack(fill_value=0)
+    stats = stats.join(hist).reset_index()
+
+    stats.to_csv(summary_dir / "queue-times.csv", sep=";", index=False)
+
+    # Print pretty report
+    console = rich.console.Console()
+    table = rich.table.Table(
+        title=f"Queue times (hours) for the period {ini_dt.date()}:{end_dt.date()}",
+    )
+    for c in stats.columns:
+        table.add_column(
+            str(c),
+            justify="left" if c in keys else "right",
+            style="cyan" if c in keys else "pink1",
+        )
+    for row in stats.itertuples(index=False):
+        table.add_row(*[str(v) for v in row])
+    console.print(table, soft_wrap=True)
+
+
+if __name__ == "__main__":
+    typer.run(main)
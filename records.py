@@ -0,0 +1,250 @@
+"""
+Compact job records.
+
+Job records are stored in slots dataclasses instead of dicts, with the most repeated
+strings (owner, namespace, Docker image, datacenter, ...) interned, so that all the
+jobs of a snapshot share a single copy of each of them. Records behave as mappings, so
+they can be used as the job dicts they replace (`job["owner"]`, `job.get(...)`,
+`dict(job)`, ...). Keys that are not known fields are kept in `extra`.
+
+Measure the memory used per record, compared to plain dicts, on a synthetic archive:
+    python records.py --jobs 100000
+"""
+
+from collections.abc import Mapping
+from dataclasses import dataclass
+import json
+from pathlib import Path
+import random
+import sys
+import tempfile
+import tracemalloc
+
+import typer
+
+
+class Record(Mapping):
+    """
+    Base class of compact records (slots dataclasses that behave as mappings).
+    """
+
+    __slots__ = ()
+    _fields = frozenset()  # names of the fields (other than `extra`)
+    _optional = frozenset()  # fields that are omitted (not set) when None
+    _interned = frozenset()  # string fields to intern
+    _nested = {}  # fields holding other records
+
+    @classmethod
+    def from_dict(
+        cls,
+        d: Mapping,
+    ):
+        """
+        Create a record from a dict (eg. parsed from a snapshot).
+        """
+        if isinstance(d, cls):
+            return d
+        kwargs, extra = {}, {}
+        for k, v in d.items():
+            if k not in cls._fields:
+                extra[k] = v
+                continue
+            if k in cls._interned and isinstance(v, str):
+                v = sys.intern(v)
+            elif k in cls._nested and v is not None:
+                v = cls._nested[k].from_dict(v)
+            kwargs[k] = v
+        return cls(**kwargs, extra=extra or None)
+
+    def to_dict(self):
+        """
+        Convert the record to a plain dict (eg. to save it as JSON).
+        """
+        return {k: v.to_dict() if isinstance(v, Record) else v for k, v in self.items()}
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            v = getattr(self, key)
+            if v is None and key in self._optional:
+                raise KeyError(key)
+            return v
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            if key in self._interned and isinstance(value, str):
+                value = sys.intern(value)
+            elif key in self._nested and value is not None:
+                value = self._nested[key].from_dict(value)
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __iter__(self):
+        for k in self.__slots__:
+            if k == "extra" or (k in self._optional and getattr(self, k) is None):
+                continue
+            yield k
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()})"
+
+
+@dataclass(slots=True, repr=False)
+class Resources(Record):
+    """
+    Resources of a job (all fields are optional, as queued jobs with errors do not have
+    resources).
+    """
+
+    cpu_num: int = None
+    cpu_MHz: int = None
+    gpu_num: int = None
+    memory_MB: int = None
+    disk_MB: int = None
+    extra: dict = None
+
+    _optional = frozenset(["cpu_num", "cpu_MHz", "gpu_num", "memory_MB", "disk_MB"])
+
+
+@dataclass(slots=True, repr=False)
+class Job(Record):
+    """
+    Job record, as returned by `take_snapshot.get_deployment()`.
+    """
+
+    job_ID: str = None
+    name: str = None
+    status: str = None
+    owner: str = None
+    title: str = None
+    description: str = None
+    docker_image: str = None
+    docker_command: str = None
+    submit_time: str = None
+    submit_ts: int = None
+    resources: Resources = None
+    endpoints: dict = None
+    active_endpoints: list = None
+    main_endpoint: str = None
+    alloc_ID: str = None
+    datacenter: str = None
+    templates: dict = None
+    error_msg: str = None
+    alloc_start: str = None
+    alloc_end: str = None
+    cluster: str = None
+    region: str = None
+    modify_index: int = None
+    original: dict = None
+    extra: dict = None
+
+    _optional = frozenset(
+        [
+            "submit_ts",
+            "templates",
+            "error_msg",
+            "cluster",
+            "region",
+            "modify_index",
+            "original",
+        ]
+    )
+    _interned = frozenset(
+        [
+            "name",
+            "status",
+            "owner",
+            "title",
+            "description",
+            "docker_image",
+            "docker_command",
+            "main_endpoint",
+            "datacenter",
+            "cluster",
+            "region",
+        ]
+    )
+    _nested = {"resources": Resources}
+
+
+Resources._fields = frozenset(Resources.__match_args__) - {"extra"}
+Job._fields = frozenset(Job.__match_args__) - {"extra"}
+
+
+def synthetic_job(
+    i: int,
+):
+    """
+    Create a synthetic job dict, similar to the ones in the snapshots.
+    """
+    rng = random.Random(i)
+    module = rng.choice(["ai4os-demo-app", "ai4os-yolov8", "ai4os-llm", "dev-env"])
+    running = rng.random() < 0.7
+    return {
+        "job_ID": f"{rng.getrandbits(128):032x}",
+        "name": f"module-{module}",
+        "status": "running" if running else "queued",
+        "owner": f"{rng.randrange(2000):04d}@egi.eu",
+        "title": "my deployment",
+        "description": f"Deployment of the {module} module",
+        "docker_image": f"ai4oshub/{module}",
+        "docker_command": "deep-start --jupyter",
+        "submit_time": "2024-09-01 10:00:00",
+        "resources": {
+            "cpu_num": rng.choice([1, 2, 4, 8]),
+            "cpu_MHz": 2000,
+            "gpu_num": rng.choice([0, 0, 1]),
+            "memory_MB": 8000,
+            "disk_MB": 10000,
+        },
+        "endpoints": {
+            "api": f"https://api-{i}.deployments.cloud.ai4eosc.eu/ui",
+            "ide": f"https://ide-{i}.deployments.cloud.ai4eosc.eu",
+        },
+        "active_endpoints": None,
+        "main_endpoint": "ide",
+        "alloc_ID": f"{rng.getrandbits(128):032x}" if running else None,
+        "datacenter": rng.choice(["ifca-ai4eosc", "iisas-ai4eosc", "tubitak"]),
+        "alloc_start": "2024-09-01T10:00:12.000000000Z" if running else None,
+        "alloc_end": None,
+    }
+
+
+def measure(
+    jobs: int = 100000,
+):
+    """
+    Measure the memory used per job record when loading a synthetic snapshot, either
+    as plain dicts or as compact records.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        pth = Path(tmp) / "snapshot.ndjson"
+        with open(pth, "w") as f:
+            for i in range(jobs):
+                f.write(json.dumps(synthetic_job(i)) + "\n")
+
+        for kind, load in [
+            ("dict", json.loads),
+            ("record", lambda line: Job.from_dict(json.loads(line))),
+        ]:
+            tracemalloc.start()
+            with open(pth, "r") as f:
+                snapshot = [load(line) for line in f]
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"{kind:>6}: {size / len(snapshot):.0f} bytes/job")
+            del snapshot
+
+
+if __name__ == "__main__":
+    typer.run(measure)
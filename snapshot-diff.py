@@ -0,0 +1,57 @@
+"""
+Show what changed in the cluster between two snapshots.
+"""
+
+from datetime import datetime
+
+import rich.console
+import rich.table
+import typer
+
+import archive
+
+
+def main(
+    ini: datetime,
+    end: datetime,
+):
+    """
+    Compare the snapshots taken at (or right before) two timestamps.
+    """
+    ini_dt, old = archive.load(ini)
+    end_dt, new = archive.load(end)
+    old = {ns: {j["job_ID"]: j for j in jobs} for ns, jobs in old.items()}
+    new = {ns: {j["job_ID"]: j for j in jobs} for ns, jobs in new.items()}
+    diff = archive.make_diff(old, new)
+
+    console = rich.console.Console()
+    table = rich.table.Table(
+        title=f"Changes between snapshots {ini_dt.isoformat()} and {end_dt.isoformat()}",
+    )
+    table.add_column("namespace", style="cyan")
+    table.add_column("job_ID", style="cyan")
+    table.add_column("owner")
+    table.add_column("change", style="pink1")
+
+    for ns in sorted(old.keys() | new.keys()):
+        for j in diff["added"].get(ns, []):
+            table.add_row(ns, j["job_ID"], j["owner"], f"added ({j['status']})")
+        for job_ID in diff["removed"].get(ns, []):
+            j = old[ns][job_ID]
+            table.add_row(ns, job_ID, j["owner"], f"removed ({j['status']})")
+        for j in diff["changed"].get(ns, []):
+            o = old[ns][j["job_ID"]]
+            fields = [
+                f"{k}: {o.get(k)} -> {j.get(k)}"
+                if k in ["status", "datacenter", "alloc_ID"]
+                else k
+                for k in sorted(o.keys() | j.keys())
+                if o.get(k) != j.get(k)
+            ]
+            table.add_row(ns, j["job_ID"], j["owner"], "\n".join(fields))
+
+    console.print(table, soft_wrap=True)
+
+
+if __name__ == "__main__":
+    typer.run(main)
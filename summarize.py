@@ -3,42 +3,128 @@ Generate a summary of the logs:
 
 * daily stats of the whole cluster and separated by namespaces
 * aggregated stats per user/namespace
+* (optional) aggregated stats per namespace and other job dimensions (eg. datacenter)
+* daily utilisation and headroom of each datacenter (from the capacity recorded in the
+  snapshots)
 """
 
 from copy import deepcopy
 from datetime import datetime
-import json
 from pathlib import Path
+import sys
 
 import pandas as pd
 import typer
 
+import archive
 import conf
+import normalize
+from usage_stats import dimensions
 
 
 main_dir = Path(__file__).resolve().parent
-snapshot_dir = main_dir / "snapshots"
 summary_dir = main_dir / "summaries"
 html_dir = main_dir / "htmls"
 
+# Resources whose capacity is recorded in the snapshots
+capacity_resources = [
+    "cpu_num",
+    "memory_MB",
+    "gpu_num",
+]
+
+
+def aggregate(
+    df: pd.DataFrame,
+    keys: list,
+    date_map: dict,
+):
+    """
+    Aggregate the resources per namespace and `keys` (in resource-day; eg. GPU-day).
+    """
+    stats = deepcopy(df)
+    stats = stats.groupby(["date", "namespace"] + keys, observed=True).sum(
+        numeric_only=True
+    )  # aggregate inside hourly snapshots
+    stats = stats.reset_index(level=0)  # move 'date' to column
+    stats["date"] = stats["date"].dt.date  # remove hours
+
+    # Perform the daily mean manually
+    # Before we did [1]. But the problem if that it biases the measures because the
+    # hours where a user have no deployments don't appear as rows in the table with cpu_num = 0.
+    # The row simply does not exist. So when you take the mean you are not taking into
+    # the empty hours, therefore you are constantly overestimating usage. To avoid this we do the
+    # mean manually by dividing the sum by the real number of snapshots that were taken that day.
+    # [1]: stats_user.groupby(['date', 'namespace', 'owner']).mean()
+    stats = stats.groupby(["date", "namespace"] + keys, observed=True).sum()
+    stats["snapshot_num"] = stats.index.get_level_values("date").map(
+        lambda x: len(date_map[x])
+    )
+    stats = stats.div(stats["snapshot_num"], axis=0)
+    stats = stats.drop(columns=["snapshot_num"])
+
+    stats = stats.groupby(["namespace"] + keys, observed=True).sum()  # aggregate days
+    stats = stats.round(0).astype(int)  # round to int
+    stats = stats.reset_index(level=keys)  # move keys to columns
+
+    return stats
+
+
+def utilisation(
+    df: pd.DataFrame,
+    capacity: pd.DataFrame,
+):
+    """
+    Daily utilisation (%) and headroom of each datacenter, from the resources used by
+    the running jobs and the capacity of the datacenter at each snapshot.
+    Snapshots without recorded capacity are skipped.
+    """
+    used = df[df["status"] == "running"]
+    used = used.groupby(["date", "datacenter"], observed=True)[capacity_resources].sum()
+
+    stats = capacity.groupby(["date", "datacenter"]).sum()  # datacenters can be shared
+    stats = stats.join(used.add_suffix("_used")).fillna(0)
+    for r in capacity_resources:
+        stats[f"{r}_headroom"] = stats[r] - stats[f"{r}_used"]
+        stats[f"{r}_util"] = (100 * stats[f"{r}_used"] / stats[r]).where(stats[r] > 0)
+
+    # Average hourly snapshots to daily average, also keeping the daily peak
+    stats = stats.reset_index(level=0)  # move 'date' to column
+    stats["date"] = stats["date"].dt.date  # remove hours
+    stats = stats.groupby(["datacenter", "date"])
+    peak = stats[[f"{r}_util" for r in capacity_resources]].max()
+    stats = stats.mean().join(peak.add_suffix("_peak"))
+    stats = stats.round(1).reset_index()
+
+    columns = ["datacenter", "date", "nodes"]
+    for r in capacity_resources:
+        columns += [r, f"{r}_used", f"{r}_headroom", f"{r}_util", f"{r}_util_peak"]
+    return stats[columns]
+
 
 def main(
     ini_date: str = None,
     end_date: str = None,
+    group_by: list[str] = None,
 ):
-    snapshot_list = sorted(snapshot_dir.glob("**/*.json"))
+    """
+    * **group_by**: also aggregate stats per namespace and these job dimensions
+      (`cluster`, `region`, `datacenter`, `docker_image`).
+    """
+    group_by = group_by or []
+    for d in group_by:
+        if d not in dimensions:
+            raise typer.BadParameter(f"Unknown group-by dimension: {d}")
+
+    snapshot_list = archive.list_snapshots()
 
     # Transform to datetimes
     # Use user values or else default to first/last snapshots
     ini_dt = (
-        datetime.strptime(ini_date, "%Y-%m-%d")
-        if ini_date
-        else datetime.strptime(snapshot_list[0].stem, "%Y-%m-%dT%H:%M:%S")
+        datetime.strptime(ini_date, "%Y-%m-%d") if ini_date else snapshot_list[0][0]
     )
     end_dt = (
-        datetime.strptime(end_date, "%Y-%m-%d")
-        if end_date
-        else datetime.strptime(snapshot_list[-1].stem, "%Y-%m-%dT%H:%M:%S")
+        datetime.strptime(end_date, "%Y-%m-%d") if end_date else snapshot_list[-1][0]
     )
     end_dt = end_dt.replace(
         hour=23, minute=59, second=59
@@ -46,6 +132,11 @@ def main(
 
     print(f"Summarizing logs for the period {ini_dt.date()}:{end_dt.date()} ...")
 
+    # Records with missing allocation times or misconfigured resources are fixed once,
+    # at ingestion. Snapshots not normalized yet are fixed in memory.
+    todo = normalize.check_archive()
+    ends = normalize.load_state()["ends"] if todo else {}
+
     # Create dict first for fast appending, then convert to Pandas Dataframe for easier
     # aggregation
     resources = [
@@ -61,76 +152,88 @@ def main(
         "owner",
         "status",
     ]
-    df = {k: [] for k in others + resources}
+    keys = list(dict.fromkeys(["datacenter"] + group_by))  # always used for capacity
+    df = {k: [] for k in others + keys + resources}
+    capacity = {k: [] for k in ["date", "datacenter", "nodes"] + capacity_resources}
 
-    # Iterate over snapshots
+    # Iterate over the job records of each snapshot (one at a time)
     namespaces = conf.NAMESPACES
-    for snapshot_pth in snapshot_list:
-        snapshot_dt = datetime.strptime(snapshot_pth.stem, "%Y-%m-%dT%H:%M:%S")
-
-        # Skip files outside the date range
-        if not (ini_dt <= snapshot_dt <= end_dt):
-            continue
-
-        # Load the snapshot
-        with open(snapshot_pth, "r") as f:
-            snapshot = json.load(f)
-
-        for namespace in namespaces:
-            for job in snapshot.get(namespace, []):
-                # Ignore queued jobs, error jobs, etc
-                if job["status"] not in ["running", "queued"]:
-                    continue
-
-                # If job is running but has no `alloc_start` let's count it as queued
-                if job["status"] == "running" and not job.get("alloc_start"):
-                    job["status"] = "queued"
-
-                # Add variables
-                df["date"].append(snapshot_pth.stem)
-                df["namespace"].append(namespace)
-                df["status"].append(job["status"])
-                df["owner"].append(job["owner"])
-
-                if job["status"] == "running":
-                    # Older jobs where misconfigured (cpuMHz was set instead of cpu_cores)
-                    # TODO: remove when old jobs no longer exist
-                    if job["resources"]["cpu_num"] == 0:
-                        job["resources"]["cpu_num"] = job["resources"]["cpu_MHz"]
-
-                    # Aggregate resources
-                    for r in resources:
-                        df[r].append(job["resources"][r])
-
-                elif job["status"] == "queued":
-                    # No resources
-                    for r in resources:
-                        df[r].append(None)
+    seen = set()  # namespaces with jobs in the current snapshot
+    for snapshot_dt, namespace, record in archive.iter_records(ini_dt, end_dt):
+        snapshot_name = snapshot_dt.isoformat()
+
+        if namespace == "_meta":
+            # The snapshot metadata is the last record of each snapshot
+            for datacenters in record.get("capacity", {}).values():
+                for dc, dc_capacity in datacenters.items():
+                    capacity["date"].append(snapshot_name)
+                    capacity["datacenter"].append(dc)
+                    for k in ["nodes"] + capacity_resources:
+                        capacity[k].append(dc_capacity[k])
 
             # If the snapshot exists, but there were not jobs running/queued, resources
             # should be set to zero in order to not skip that timestamp in the time series
             # We should only skip the timestamp if the snapshot wasn't taken.
-            if not snapshot.get(namespace, []):
-                df["date"].append(snapshot_pth.stem)
-                df["namespace"].append(namespace)
+            for ns in namespaces:
+                if ns in seen:
+                    continue
+                df["date"].append(snapshot_name)
+                df["namespace"].append(ns)
                 df["status"].append(None)
                 df["owner"].append(None)
+                for d in keys:
+                    df[d].append(None)
 
                 for r in resources:
                     df[r].append(0)
 
+            seen = set()
+            continue
+
+        if namespace not in namespaces:
+            continue
+        seen.add(namespace)
+
+        job = record
+        if snapshot_name in todo:
+            normalize.fix_job(job, ends, snapshot_name)
+
+        # Ignore queued jobs, error jobs, etc
+        if job["status"] not in ["running", "queued"]:
+            continue
+
+        # Add variables
+        df["date"].append(snapshot_name)
+        df["namespace"].append(namespace)
+        # Intern strings so that repeated values share memory across rows
+        df["status"].append(sys.intern(job["status"]))
+        df["owner"].append(sys.intern(job["owner"]))
+        for d in keys:
+            df[d].append(sys.intern(job.get(d) or ""))
+
+        if job["status"] == "running":
+            # Aggregate resources
+            for r in resources:
+                df[r].append(job["resources"][r])
+
+        elif job["status"] == "queued":
+            # No resources
+            for r in resources:
+                df[r].append(None)
+
     # Convert to Dataframe
     df = pd.DataFrame.from_dict(df)
     df["date"] = pd.to_datetime(df["date"])
+    df = df.astype({d: "category" for d in keys})
 
     ####################################################################################
     # Generate timeseries                                                              #
     ####################################################################################
 
     # Generate namespace time series
-    stats_ns = df.groupby(
-        ["date", "namespace"]
-    ).sum()  # average jobs inside the same snapshot
+    stats_ns = df.groupby(["date", "namespace"]).sum(
+        numeric_only=True
+    )  # average jobs inside the same snapshot
     stats_ns = stats_ns.reset_index(level=0)  # move 'date' to column
     stats_ns["date"] = stats_ns["date"].dt.date  # remove hours
     stats_ns = stats_ns.groupby(
@@ -139,14 +242,14 @@ def main(
     stats_ns = stats_ns.round(0).astype(int)  # round to int
 
     # Add running/queued jobs to the time series
-    stats_status = df[["date", "namespace", "status"]].value_counts()
+    stats_status = df[["date", "namespace", "status"]].value_counts().rename("count")
     stats_status = stats_status.reset_index(level=0)  # move 'date' to column
     stats_status["date"] = stats_status["date"].dt.date  # remove hours
     stats_status = stats_status.groupby(
         ["date", "namespace", "status"]
     ).mean()  # average hourly snapshots to daily average
     stats_status = stats_status.reset_index(level=2)  # move 'status' to column
-    stats_status = stats_status.pivot(columns=["status"])[0]
+    stats_status = stats_status.pivot(columns=["status"])["count"]
     stats_status = stats_status.fillna(
         0
     )  # fill when no jobs with that status that date
@@ -173,6 +276,17 @@ def main(
             index=False,
         )
 
+    # Generate datacenter utilisation time series
+    capacity = pd.DataFrame.from_dict(capacity)
+    capacity["date"] = pd.to_datetime(capacity["date"])
+    if len(capacity):
+        stats_dc = utilisation(df, capacity)
+        stats_dc.to_csv(
+            summary_dir / "datacenters-timeseries.csv",
+            sep=";",
+            index=False,
+        )
+
     ####################################################################################
     # Aggregate user stats per namespace (in resource-day; eg. GPU-day)                #
     ####################################################################################
@@ -186,31 +300,10 @@ def main(
         v = date_map.get(k, [])
         date_map[k] = v + [date_hour]
 
-    # Start aggregating
-    stats_user = deepcopy(df)
-    stats_user = stats_user.groupby(
-        ["date", "namespace", "owner"]
-    ).sum()  # aggregate inside hourly snapshots
-    stats_user = stats_user.reset_index(level=0)  # move 'date' to column
-    stats_user["date"] = stats_user["date"].dt.date  # remove hours
+    stats_user = aggregate(df, ["owner"], date_map)
 
-    # Perform the daily mean manually
-    # Before we did [1]. But the problem if that it biases the measures because the
-    # hours where a user have no deployments don't appear as rows in the table with cpu_num = 0.
-    # The row simply does not exist. So when you take the mean you are not taking into
-    # the empty hours, therefore you are constantly overestimating usage. To avoid this we do the
-    # mean manually by dividing the sum by the real number of snapshots that were taken that day.
-    # [1]: stats_user.groupby(['date', 'namespace', 'owner']).mean()
-    stats_user = stats_user.groupby(["date", "namespace", "owner"]).sum()
-    stats_user["snapshot_num"] = stats_user.index.get_level_values("date").map(
-        lambda x: len(date_map[x])
-    )
-    stats_user = stats_user.div(stats_user["snapshot_num"], axis=0)
-    stats_user = stats_user.drop(columns=["snapshot_num"])
-
-    stats_user = stats_user.groupby(["namespace", "owner"]).sum()  # aggregate days
-    stats_user = stats_user.round(0).astype(int)  # round to int
-    stats_user = stats_user.reset_index(level=1)  # move 'owner' to column
+    # Save all namespaces in a single file, so that they can be merged in one pass
+    stats_user.to_csv(summary_dir / "users-agg.csv", sep=";")
 
     for namespace in namespaces:
         if namespace in stats_user.index:
@@ -244,6 +337,19 @@ def main(
                 summary_dir / f"{namespace}-full-agg.csv", sep=";", index=False
             )
 
+    ####################################################################################
+    # Aggregate stats per namespace and group-by dimensions (in resource-day)          #
+    ####################################################################################
+
+    if group_by:
+        stats_group = aggregate(df[df["status"] == "running"], group_by, date_map)
+        stats_group.to_csv(
+            summary_dir / f"{'-'.join(group_by)}-agg.csv",
+            sep=";",
+        )
+
+    return stats_user
+
 
 if __name__ == "__main__":
     typer.run(main)
@@ -2,17 +2,29 @@
 Take a snapshot of the current state of the cluster.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import functools
 import json
+import os
 from pathlib import Path
+import queue
+import random
 import re
+import threading
+import time
 import types
 
 import nomad
 import requests
+import typer
 
+import archive
 import conf
+import events
 import nomad_patches
+import normalize
+from records import Job, Record
 
 
 # Disable insecure requests warning
@@ -20,24 +32,164 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
-# Production
-Nomad = nomad.Nomad()
 
-Nomad.job.deregister_job = types.MethodType(nomad_patches.deregister_job, Nomad.job)
-Nomad.job.get_allocations = types.MethodType(nomad_patches.get_allocations, Nomad.job)
-Nomad.job.get_evaluations = types.MethodType(nomad_patches.get_allocations, Nomad.job)
+def patch(
+    client: nomad.Nomad,
+):
+    """
+    Apply the Nomad patches to a client.
+    """
+    client.job.deregister_job = types.MethodType(
+        nomad_patches.deregister_job, client.job
+    )
+    client.job.get_allocations = types.MethodType(
+        nomad_patches.get_allocations, client.job
+    )
+    client.job.get_evaluations = types.MethodType(
+        nomad_patches.get_allocations, client.job
+    )
+    return client
+
+
+# Production
+Nomad = patch(nomad.Nomad())
 
 snapshot_dir = Path(__file__).resolve().parent / "snapshots"
+partial_dir = snapshot_dir / ".partial"
 
 
 # Persistent requests session for faster requests
 session = requests.Session()
 
+# Reasons to collect the expensive details of a job, by priority
+detail_tiers = [
+    "new",
+    "changed",
+    "sampled",
+]
+
+# Expensive details of a job, only collected for the jobs picked by the details policy
+detail_fields = [
+    "templates",
+    "active_endpoints",
+]
+
+# Patterns to parse the job spec
+host_patterns = [
+    re.compile(r"Host\(`(.+?)`"),
+    re.compile(r"HostSNI\(`(.+?)`"),
+]
+service_pattern = re.compile("deep-start --(.*)$")
+
+
+def spec_key(
+    usertask: dict,
+    group: dict,
+):
+    """
+    Split a job spec (main task and its task group) into the fields that are shared by
+    the jobs deployed from the same module template, and the hostnames of the jobs.
+
+    Returns a hashable key of the shared fields (Docker image, command, requested
+    resources and services, with the hostnames stripped from their tags), and the
+    hostname of each service (None if missing).
+    """
+    services, hosts = [], []
+    for s in group.get("Services", []) or []:
+        # Find the first `Host` tag, and strip the hostname from it
+        tags, host = [], None
+        for t in s["Tags"]:
+            for pattern in host_patterns:
+                match = pattern.search(t)
+                if match:
+                    if host is None:
+                        host = match.group(1)
+                    t = t[: match.start(1)] + t[match.end(1) :]
+                    break
+            tags.append(t)
+        services.append((s["PortLabel"], tuple(tags)))
+        hosts.append(host)
+
+    res = usertask["Resources"]
+    gpu = next((d for d in res.get("Devices") or [] if d["Name"] == "gpu"), None)
+    key = (
+        usertask["Config"]["image"],
+        usertask["Config"].get("command", ""),
+        tuple(str(a) for a in usertask["Config"].get("args", [])),
+        (
+            res["Cores"],
+            res["MemoryMB"],
+            gpu["Count"] if gpu else 0,
+            (group.get("EphemeralDisk") or {}).get("SizeMB"),
+        ),
+        tuple(services),
+    )
+    return key, hosts
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_spec(
+    key: tuple,
+):
+    """
+    Translate the shared fields of a job spec (see `spec_key`) into the job info that
+    does not depend on the allocation: Docker image and command, endpoint labels (and
+    URL suffixes) of each service, main endpoint and requested resources.
+
+    Results are cached, as many jobs share the same spec (they are deployed from the
+    same module templates). Do not modify the returned dicts.
+    """
+    image, command, args, (cores, memory, gpus, disk), services = key
+    info = {}
+
+    # Retrieve Docker image
+    info["docker_image"] = image
+    info["docker_command"] = f"{command} {' '.join(args)}".strip()
+
+    # Add endpoints (the URL of each service is filled with its hostname later on)
+    info["endpoints"] = []
+    for label, _ in services:
+        # Old deployments had network ports with names [deepaas, ide, monitor]
+        # instead of [api, ide, monitor] so we have to manually replace them
+        # see: https://github.com/AI4EOSC/ai4-papi/issues/22
+        if label == "deepaas":
+            label = "api"
+
+        # Add '/ui' to deepaas endpoint
+        # If in the future we support other APIs, this will have to be removed.
+        info["endpoints"].append((label, "/ui" if label == "api" else ""))
+
+    # Add quick-access (main endpoint) + customize endpoints
+    service2endpoint = {
+        "deepaas": "api",
+        "jupyter": "ide",
+        "vscode": "ide",
+    }
+    try:  # deep-start compatible service
+        service = service_pattern.search(info["docker_command"]).group(1)
+        info["main_endpoint"] = service2endpoint[service]
+
+    except Exception:  # return first endpoint
+        endpoints = list(dict(info["endpoints"]).keys())
+        info["main_endpoint"] = endpoints[0] if endpoints else None
+
+    # Requested resources (used for jobs that are not yet allocated)
+    info["resources"] = {
+        "cpu_num": cores,
+        "cpu_MHz": 0,  # not known before allocation
+        "gpu_num": gpus,
+        "memory_MB": memory,
+        "disk_MB": disk,
+    }
+
+    return info
+
 
 def get_deployment(
     deployment_uuid: str,
     namespace: str,
     full_info: bool = False,
+    client: nomad.Nomad = None,
 ):
     """
     Retrieve the info of a specific deployment.
@@ -46,10 +198,15 @@ def get_deployment(
     Parameters:
     * **vo**: Virtual Organization from where you want to retrieve your deployment
     * **deployment_uuid**: uuid of deployment to gather info about
+    * **full_info**: also retrieve the expensive details (templates and active
+      endpoints, which are probed)
+    * **client**: Nomad client of the cluster where the deployment is (default: the
+      cluster of the `NOMAD_*` environment variables)
 
-    Returns a dict with info
+    Returns a job record (`records.Job`) with info
     """
-    j = Nomad.job.get_job(
+    client = client or Nomad
+    j = client.job.get_job(
         id_=deployment_uuid,
         namespace=namespace,
     )
@@ -67,6 +224,8 @@ def get_deployment(
         "submit_time": datetime.fromtimestamp(j["SubmitTime"] // 1000000000).strftime(
             "%Y-%m-%d %H:%M:%S"
         ),  # nanoseconds to timestamp
+        "submit_ts": j["SubmitTime"] // 1000000000,  # UTC timestamp (seconds)
+        "modify_index": j["ModifyIndex"],  # to know if the job changed
         "resources": {},
         "endpoints": {},
         "active_endpoints": None,
@@ -79,65 +238,16 @@ def get_deployment(
     tasks = j["TaskGroups"][0]["Tasks"]
     usertask = [t for t in tasks if t["Name"] == "main"][0]
 
-    # Retrieve Docker image
-    info["docker_image"] = usertask["Config"]["image"]
-    command = usertask["Config"].get("command", "")
-    args = usertask["Config"].get("args", [])
-    args[:] = [str(a) for a in args]
-    info["docker_command"] = f"{command} {' '.join(args)}".strip()
-
-    # Add endpoints
-    info["endpoints"] = {}
-    services = j["TaskGroups"][0].get("Services", []) or []
-    for s in services:
-        label = s["PortLabel"]
-
-        # Iterate through tags to find `Host` tag
-        url = "missing-endpoint"
-        for t in s["Tags"]:
-            patterns = [
-                r"Host\(`(.+?)`",
-                r"HostSNI\(`(.+?)`",
-            ]
-            for pattern in patterns:
-                match = re.search(pattern, t)
-                if match:
-                    url = match.group(1)
-                    break
-
-            if url != "missing-endpoint":
-                break
-
-        # Old deployments had network ports with names [deepaas, ide, monitor]
-        # instead of [api, ide, monitor] so we have to manually replace them
-        # see: https://github.com/AI4EOSC/ai4-papi/issues/22
-        if label == "deepaas":
-            label = "api"
-
-        info["endpoints"][label] = f"https://{url}"
-
-    # Add '/ui' to deepaas endpoint
-    # If in the future we support other APIs, this will have to be removed.
-    if "api" in info["endpoints"].keys():
-        info["endpoints"]["api"] += "/ui"
-
-    # Add quick-access (main endpoint) + customize endpoints
-    service2endpoint = {
-        "deepaas": "api",
-        "jupyter": "ide",
-        "vscode": "ide",
+    # Parse the job spec (cached, as many jobs share the same spec)
+    key, hosts = spec_key(usertask, j["TaskGroups"][0])
+    parsed = parse_spec(key)
+    info["docker_image"] = parsed["docker_image"]
+    info["docker_command"] = parsed["docker_command"]
+    info["endpoints"] = {
+        label: f"https://{host or 'missing-endpoint'}{suffix}"
+        for (label, suffix), host in zip(parsed["endpoints"], hosts)
     }
-    try:  # deep-start compatible service
-        service = re.search(
-            "deep-start --(.*)$",
-            info["docker_command"],
-        ).group(1)
-
-        info["main_endpoint"] = service2endpoint[service]
-
-    except Exception:  # return first endpoint
-        endpoints = list(info["endpoints"].keys())
-        info["main_endpoint"] = endpoints[0] if endpoints else None
+    info["main_endpoint"] = parsed["main_endpoint"]
 
     # Add user script for batch jobs
     if full_info:
@@ -147,11 +257,11 @@ def get_deployment(
             info["templates"][t["DestPath"]] = t["EmbeddedTmpl"].replace("\n ", "\n")
 
     # Only fill resources if the job is allocated
-    allocs = Nomad.job.get_allocations(
+    allocs = client.job.get_allocations(
         id_=j["ID"],
         namespace=namespace,
     )
-    evals = Nomad.job.get_evaluations(
+    evals = client.job.get_evaluations(
         id_=j["ID"],
         namespace=namespace,
     )
@@ -183,13 +293,13 @@ def get_deployment(
             # Return most recent allocation
             idx = 0
 
-        a = Nomad.allocation.get_allocation(allocs[idx]["ID"])
+        a = client.allocation.get_allocation(allocs[idx]["ID"])
 
         # Add ID
         info["alloc_ID"] = a["ID"]
 
         # Add datacenter
-        info["datacenter"] = Nomad.node.get_node(a["NodeID"])["Datacenter"]
+        info["datacenter"] = client.node.get_node(a["NodeID"])["Datacenter"]
 
         # Replace Nomad status with a more user-friendly status
         # Final list includes: starting, down, running, complete, failed, dead, ...
@@ -244,7 +354,7 @@ def get_deployment(
         }
 
         # Retrieve the node the jobs landed at in order to properly fill the endpoints
-        n = Nomad.node.get_node(a["NodeID"])
+        n = client.node.get_node(a["NodeID"])
         for k, v in info["endpoints"].items():
             info["endpoints"][k] = v.replace("${meta.domain}", n["Meta"]["domain"])
 
@@ -286,19 +396,7 @@ def get_deployment(
         info["status"] = "queued"
 
         # Fill info with _requested_ resources instead
-        res = usertask["Resources"]
-        gpu = (
-            [d for d in res["Devices"] if d["Name"] == "gpu"][0]
-            if res["Devices"]
-            else None
-        )
-        info["resources"] = {
-            "cpu_num": res["Cores"],
-            "cpu_MHz": 0,  # not known before allocation
-            "gpu_num": gpu["Count"] if gpu else 0,
-            "memory_MB": res["MemoryMB"],
-            "disk_MB": j["TaskGroups"][0]["EphemeralDisk"]["SizeMB"],
-        }
+        info["resources"] = dict(parsed["resources"])
 
     # ==================================================================================#
     # ADD SOME ACCOUNTING-SPECIFIC CODE                                                #
@@ -317,39 +415,669 @@ def get_deployment(
 
     # ==================================================================================#
 
-    return info
+    return Job.from_dict(info)
 
 
-if __name__ == "__main__":
-    print("Taking snapshot of the Nomad cluster")
-
-    namespaces = conf.NAMESPACES
-    snapshot = {k: [] for k in namespaces}
-    for namespace in namespaces:
-        print(f"  Processing {namespace} ...")
-
-        jobs = Nomad.jobs.get_jobs(namespace=namespace)  # job summaries
-        for j in jobs:
-            # Skip jobs that do not start with userjob
-            # (useful for admins who might have deployed other jobs eg. Traefik)
-            if not (
-                j["Name"].startswith("module")
-                or j["Name"].startswith("tool")
-                or j["Name"].startswith("batch")
-            ):
+def is_userjob(
+    name: str,
+):
+    """
+    Whether a job was deployed by a user.
+    Useful to skip admin jobs (eg. Traefik).
+    """
+    return (
+        name.startswith("module") or name.startswith("tool") or name.startswith("batch")
+    )
+
+
+def new_policy(
+    known: dict,
+    budget: int,
+    sample_rate: float,
+):
+    """
+    Create the policy that decides which jobs get their expensive details collected.
+
+    * **known**: records of the jobs in the last snapshot, by (namespace, job ID).
+    * **budget**: max number of jobs whose details are collected.
+    * **sample_rate**: fraction of the unchanged jobs whose details are refreshed.
+    """
+    return {
+        "known": known,
+        "budget": budget,
+        "sample_rate": sample_rate,
+        "counts": {t: 0 for t in detail_tiers + ["over_budget"]},
+    }
+
+
+def load_known():
+    """
+    Records of the jobs in the last snapshot, by (namespace, job ID).
+    """
+    try:
+        _, snapshot = archive.load(datetime.utcnow())
+    except ValueError:  # empty archive
+        return {}
+    return {(ns, j["job_ID"]): j for ns, jobs in snapshot.items() for j in jobs}
+
+
+def detail_tier(
+    policy: dict,
+    namespace: str,
+    job_ID: str,
+    modify_index: int = None,
+):
+    """
+    Reason to collect the expensive details (templates, active endpoints) of a job:
+    it is new, it changed since the last snapshot (different modify index, or unknown)
+    or it is randomly sampled. Returns None if there is no reason to collect them.
+    """
+    if policy is None:
+        return None
+    old = policy["known"].get((namespace, job_ID))
+    if old is None:
+        return "new"
+    elif modify_index is None or old.get("modify_index") != modify_index:
+        return "changed"
+    elif random.random() < policy["sample_rate"]:
+        return "sampled"
+    return None
+
+
+def use_budget(
+    policy: dict,
+    tier: str,
+):
+    """
+    Whether there is budget left in the policy to collect the details of a job (of a
+    given tier), counting it if so.
+    """
+    counts = policy["counts"]
+    if sum(counts[t] for t in detail_tiers) >= policy["budget"]:
+        counts["over_budget"] += 1
+        return False
+    counts[tier] += 1
+    return True
+
+
+def wants_details(
+    policy: dict,
+    namespace: str,
+    job_ID: str,
+    modify_index: int = None,
+):
+    """
+    Whether to collect the expensive details of a job, while the budget of the policy
+    lasts (see `detail_tier()`). Accounting fields are always collected.
+    """
+    tier = detail_tier(policy, namespace, job_ID, modify_index)
+    return tier is not None and use_budget(policy, tier)
+
+
+def carry_details(
+    policy: dict,
+    namespace: str,
+    job: dict,
+):
+    """
+    Copy the expensive details of a job from the last snapshot (see `new_policy()`),
+    if they were not collected this time and the job did not change since then (same
+    modify index). The job is modified in place.
+    """
+    if policy is None or "templates" in job or job.get("modify_index") is None:
+        return
+    old = policy["known"].get((namespace, job["job_ID"]))
+    if old is None or old.get("modify_index") != job["modify_index"]:
+        return
+    for k in detail_fields:
+        if k in old:
+            job[k] = old[k]
+
+
+def report_details(
+    policy: dict,
+):
+    """
+    Print how much of the details budget was used, and why.
+    """
+    counts = policy["counts"]
+    used = sum(counts[t] for t in detail_tiers)
+    tiers = ", ".join(f"{t}: {counts[t]}" for t in detail_tiers)
+    print(f"Details collected for {used}/{policy['budget']} jobs ({tiers})")
+    if counts["over_budget"]:
+        print(f"  {counts['over_budget']} jobs skipped (budget exhausted)")
+
+
+def iter_jobs(
+    clusters: list,
+    done: set = frozenset(),
+    failed: list = None,
+    retries: int = 0,
+    backoff: float = 5,
+    policy: dict = None,
+):
+    """
+    Retrieve the info of all the user jobs in the clusters, one job at a time.
+
+    Clusters are crawled concurrently, each one with at most `cluster["concurrency"]`
+    simultaneous requests. Jobs are tagged with the name and region of their cluster.
+
+    * **done**: `(namespace, job ID)` of the jobs already retrieved (eg. when resuming),
+      they are not fetched again.
+    * **failed**: list where to add the `(cluster, namespace, job ID)` that could not be
+      retrieved (job ID is None if the whole namespace failed, namespace is None if the
+      namespaces of the cluster could not be listed).
+    * **retries**: number of retry passes for the jobs (or namespaces) that failed.
+    * **backoff**: seconds to wait before the first retry pass (doubled each time).
+    * **policy**: which jobs get their expensive details collected (see
+      `new_policy()`), by default none. The jobs that are candidates for details are
+      only retrieved once all the namespaces are listed, so that the budget goes to
+      them by priority (`detail_tiers`).
+
+    Yields tuples `(namespace, job)`.
+    """
+    failed = failed if failed is not None else []
+    by_name = {c["name"]: c for c in clusters}
+    pools = {
+        c["name"]: ThreadPoolExecutor(max_workers=c["concurrency"]) for c in clusters
+    }
+    pending = {}
+    listing = set()  # namespaces (or clusters) being listed
+    candidates = []  # jobs waiting for their details tier to be prioritized
+
+    def submit(cluster, namespace, job_ID, full_info=False):
+        client = patch(cluster["client"])
+        pool = pools[cluster["name"]]
+        if namespace is None:
+            future = pool.submit(conf.get_namespaces, cluster)
+            listing.add(future)
+        elif job_ID is None:
+            future = pool.submit(client.jobs.get_jobs, namespace=namespace)
+            listing.add(future)
+        else:
+            future = pool.submit(
+                get_deployment,
+                deployment_uuid=job_ID,
+                namespace=namespace,
+                full_info=full_info,
+                client=client,
+            )
+        pending[future] = (cluster, namespace, job_ID)
+
+    todo = [(c["name"], None, None) for c in clusters]
+    try:
+        for attempt in range(retries + 1):
+            if attempt:
+                print(f"  Retrying {len(todo)} failed items (attempt {attempt}) ...")
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+            failed.clear()
+            for name, namespace, job_ID in todo:
+                submit(by_name[name], namespace, job_ID)
+
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    cluster, namespace, job_ID = pending.pop(future)
+                    listing.discard(future)
+                    name = cluster["name"]
+                    try:
+                        res = future.result()
+                    except Exception as e:
+                        if job_ID is not None and isinstance(
+                            e, nomad.api.exceptions.URLNotFoundNomadException
+                        ):
+                            # Job purged between the listing and the fetch, it no
+                            # longer exists so there is nothing to retry
+                            print(f"   Skipping {job_ID}, no longer exists")
+                            continue
+                        if namespace is None:
+                            print(f"   Failed to list namespaces of {name}: {e}")
+                        elif job_ID is None:
+                            print(f"   Failed to list jobs of {name}:{namespace}: {e}")
+                        else:
+                            print(f"   Failed to retrieve {job_ID}: {e}")
+                        failed.append((name, namespace, job_ID))
+                        continue
+
+                    if namespace is None:
+                        for ns in res:
+                            submit(cluster, ns, None)
+
+                    elif job_ID is None:  # job summaries
+                        print(f"  Processing {name}:{namespace} ...")
+                        # Skip jobs that do not start with userjob and jobs already
+                        # retrieved
+                        for j in res:
+                            if (
+                                is_userjob(j["Name"])
+                                and (namespace, j["ID"]) not in done
+                            ):
+                                tier = detail_tier(
+                                    policy, namespace, j["ID"], j["ModifyIndex"]
+                                )
+                                if tier is None:
+                                    submit(cluster, namespace, j["ID"])
+                                else:
+                                    candidates.append((tier, cluster, namespace, j))
+
+                    else:
+                        res["cluster"] = name
+                        res["region"] = cluster["region"]
+                        carry_details(policy, namespace, res)
+                        yield namespace, res
+
+                # Once all the namespaces are listed, the budget goes to the new jobs
+                # first, then to the changed ones and then to the sampled ones
+                if candidates and not listing:
+                    candidates.sort(key=lambda c: detail_tiers.index(c[0]))
+                    for tier, cluster, namespace, j in candidates:
+                        full_info = use_budget(policy, tier)
+                        submit(cluster, namespace, j["ID"], full_info)
+                    candidates.clear()
+
+            todo = list(failed)
+            if not todo:
+                break
+
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def collect(
+    clusters: list,
+    policy: dict = None,
+):
+    """
+    Retrieve the info of all the user jobs in the clusters (with the expensive details
+    of the jobs selected by the `policy`, if any).
+
+    Returns a tuple `(snapshot, failed)`, with the jobs of each namespace indexed by job
+    ID and the list of `(cluster, namespace, job ID)` that could not be retrieved.
+    """
+    snapshot, failed = {}, []
+    for namespace, job in iter_jobs(clusters, failed=failed, policy=policy):
+        snapshot.setdefault(namespace, {})[job["job_ID"]] = job
+    for c in clusters:
+        for namespace in c.get("namespaces", []):
+            snapshot.setdefault(namespace, {})
+    return snapshot, failed
+
+
+def get_capacity(
+    client: nomad.Nomad,
+):
+    """
+    Retrieve the capacity of each datacenter of a cluster, with a single (bulk) node
+    listing.
+
+    Only nodes that are ready are counted. Returns a dict with the number of nodes,
+    CPU cores, memory (minus the memory reserved for the node) and GPUs of each
+    datacenter.
+    """
+    capacity = {}
+    for n in client.nodes.get_nodes(resources=True):
+        if n["Status"] != "ready":
+            continue
+        res = n.get("NodeResources") or {}
+        reserved = n.get("ReservedResources") or {}
+
+        # Only reservable cores can be assigned to jobs (`resources.cores`)
+        cpu = res.get("Cpu") or {}
+        cores = len(cpu.get("ReservableCpuCores") or []) or cpu.get("TotalCpuCores", 0)
+        memory = (res.get("Memory") or {}).get("MemoryMB", 0)
+        memory -= (reserved.get("Memory") or {}).get("MemoryMB", 0)
+        gpus = [d for d in res.get("Devices") or [] if d.get("Type") == "gpu"]
+
+        dc = capacity.setdefault(
+            n["Datacenter"],
+            {"nodes": 0, "cpu_num": 0, "memory_MB": 0, "gpu_num": 0},
+        )
+        dc["nodes"] += 1
+        dc["cpu_num"] += cores
+        dc["memory_MB"] += memory
+        dc["gpu_num"] += sum(len(d.get("Instances") or []) for d in gpus)
+    return capacity
+
+
+def collect_capacity(
+    clusters: list,
+):
+    """
+    Retrieve the capacity of the datacenters of all the clusters.
+
+    Returns a dict with the capacity of each datacenter, per cluster name. Clusters
+    whose nodes could not be listed are skipped.
+    """
+    capacity = {}
+    for c in clusters:
+        try:
+            capacity[c["name"]] = get_capacity(c["client"])
+        except Exception as e:
+            print(f"   Failed to list nodes of {c['name']}: {e}")
+    return capacity
+
+
+def write_record(
+    f,
+    namespace: str,
+    job: dict,
+):
+    """
+    Write a job record to a (NDJSON) snapshot file.
+    """
+    f.write(json.dumps({"namespace": namespace, **job}, default=Record.to_dict) + "\n")
+
+
+def write_meta(
+    f,
+    failed: list,
+    capacity: dict = None,
+    policy: dict = None,
+):
+    """
+    Write the snapshot metadata as the last line of a (NDJSON) snapshot file, then
+    flush it to disk.
+
+    The metadata records whether the snapshot is complete, along with the jobs (or
+    namespaces, or clusters) that could not be retrieved, the capacity of the
+    datacenters of each cluster (if known) and the jobs whose details were collected.
+    """
+    meta = {
+        "complete": not failed,
+        "failed": [
+            f"{c}:{ns or '*'}/{k or '*'}" for c, ns, k in failed
+        ],  # cluster:namespace/job
+    }
+    if capacity:
+        meta["capacity"] = capacity
+    if policy:
+        meta["details"] = {"budget": policy["budget"], **policy["counts"]}
+    f.write(json.dumps({"_meta": meta}) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def save(
+    snapshot: dict,
+    failed: list = None,
+    name: str = None,
+    capacity: dict = None,
+    policy: dict = None,
+):
+    """
+    Save a snapshot from memory (jobs of each namespace, indexed by job ID).
+
+    The snapshot is written (and normalized) to a temporary file first and then
+    renamed, so readers never see partial snapshots.
+    """
+    name = name or datetime.utcnow().replace(microsecond=0).isoformat()
+    tmp_pth = snapshot_dir / f".{name}.ndjson.tmp"
+    with open(tmp_pth, "w") as f:
+        for namespace, jobs in snapshot.items():
+            for job in jobs.values():
+                write_record(f, namespace, job)
+        write_meta(f, failed or [], capacity, policy)
+    normalize.ingest(tmp_pth, name)
+    os.replace(tmp_pth, snapshot_dir / f"{name}.ndjson")
+
+
+def commit(
+    pth: Path,
+    failed: list,
+    capacity: dict = None,
+    policy: dict = None,
+):
+    """
+    Turn a partial snapshot into a final (normalized) snapshot.
+    """
+    with open(pth, "a") as f:
+        write_meta(f, failed, capacity, policy)
+    normalize.ingest(pth, pth.stem)
+    os.replace(pth, snapshot_dir / pth.name)
+
+
+def take_snapshot(
+    clusters: list,
+    retries: int,
+    max_resume: float,
+    detail_budget: int,
+    detail_sample: float,
+):
+    """
+    Take a snapshot, streaming the job records to a partial file as they are retrieved
+    (so memory usage does not grow with the size of the cluster). If a previous run was
+    interrupted, resume it and only retrieve the missing jobs.
+
+    * **max_resume**: partial snapshots older than this (in hours) are no longer
+      resumed, but saved as incomplete snapshots.
+    * **detail_budget**, **detail_sample**: see `new_policy()`.
+    """
+    partial_dir.mkdir(exist_ok=True)
+    interrupted = [("*", None, None)]  # we do not know what is missing
+
+    now = datetime.utcnow().replace(microsecond=0)
+    partials = sorted(partial_dir.glob("*.ndjson"))
+    for pth in partials[:-1]:  # only the last partial snapshot can be resumed
+        read_partial(pth)
+        commit(pth, failed=interrupted)
+    pth = partials[-1] if partials else None
+    if (
+        pth
+        and (now - datetime.fromisoformat(pth.stem)).total_seconds() > max_resume * 3600
+    ):
+        print(f"Saving stale partial snapshot {pth.stem} as incomplete")
+        read_partial(pth)
+        commit(pth, failed=interrupted)
+        pth = None
+
+    if pth:
+        print(f"Resuming partial snapshot {pth.stem}")
+        done = read_partial(pth)
+    else:
+        pth = partial_dir / f"{now.isoformat()}.ndjson"
+        done = set()
+
+    failed = []
+    policy = new_policy(load_known(), detail_budget, detail_sample)
+    with open(pth, "a") as f:
+        for namespace, job in iter_jobs(
+            clusters, done, failed, retries=retries, policy=policy
+        ):
+            write_record(f, namespace, job)
+            f.flush()
+
+    commit(pth, failed, collect_capacity(clusters), policy)
+    report_details(policy)
+    if failed:
+        print(f"Snapshot saved as incomplete ({len(failed)} items failed)")
+
+
+def read_partial(
+    pth: Path,
+):
+    """
+    Return the `(namespace, job ID)` of the jobs already written in a partial snapshot.
+    The last record is dropped if it was truncated (process killed while writing).
+    """
+    done, size = set(), 0
+    with open(pth, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            job = json.loads(line)
+            done.add((job["namespace"], job["job_ID"]))
+            size += len(line)
+    os.truncate(pth, size)
+    return done
+
+
+def forward(
+    cluster: dict,
+    stream: threading.Thread,
+    event_queue: queue.Queue,
+    merged: queue.Queue,
+):
+    """
+    Forward the events of a cluster stream to the queue shared by all clusters, until
+    the stream dies.
+    """
+    while stream.is_alive() or not event_queue.empty():
+        try:
+            merged.put((cluster, event_queue.get(timeout=1)))
+        except queue.Empty:
+            continue
+
+
+def run_daemon(
+    clusters: list,
+    interval: float,
+    detail_budget: int,
+    detail_sample: float,
+):
+    """
+    Keep an in-memory model of the clusters, updated with the Nomad event streams, and
+    save it as a snapshot every `interval` hours.
+
+    Only jobs that change are re-fetched from Nomad. Allocation start/stop transitions
+    are recorded to the event log as soon as they are seen. Jobs that are garbage
+    collected between snapshots are kept in the model until the next snapshot is
+    saved, so they are always accounted for. The expensive details of jobs are
+    collected with a new budget after each snapshot (see `new_policy()`).
+    """
+    model = {}
+    gone = set()  # (namespace, job ID) of jobs no longer in Nomad
+    streams = {}  # event stream of each cluster
+    merged = queue.Queue()  # events of all clusters
+    next_dt = time.monotonic()
+    policy = new_policy(load_known(), detail_budget, detail_sample)
+
+    while True:
+        # (Re)subscribe to the event streams and do a full sync of the model, as we
+        # might have missed events
+        if len(streams) < len(clusters) or not all(
+            s.is_alive() for s in streams.values()
+        ):
+            print("Syncing the cluster model")
+            for c in clusters:
+                if c["name"] in streams and streams[c["name"]].is_alive():
+                    continue
+                stream, stream_exit, event_queue = c["client"].event.stream.get_stream(
+                    topic=["Job", "Allocation"],
+                    namespace="*",
+                    timeout=60,  # Nomad sends heartbeats every 10s
+                )
+                stream.daemon = True
+                stream.start()
+                threading.Thread(
+                    target=forward,
+                    args=(c, stream, event_queue, merged),
+                    daemon=True,
+                ).start()
+                streams[c["name"]] = stream
+
+            current, _ = collect(clusters, policy)
+            for namespace in current.keys() | model.keys():
+                ns_current = current.setdefault(namespace, {})
+                for job_ID, new in ns_current.items():
+                    old = model.get(namespace, {}).get(job_ID)
+                    events.append(events.transitions(namespace, old, new))
+                for job_ID in model.get(namespace, {}).keys() - ns_current.keys():
+                    ns_current[job_ID] = model[namespace][job_ID]
+                    gone.add((namespace, job_ID))
+            model = current
+
+        # Save snapshot from memory
+        if time.monotonic() >= next_dt:
+            print("Taking snapshot of the Nomad cluster")
+            save(model, capacity=collect_capacity(clusters), policy=policy)
+            report_details(policy)
+            for namespace, job_ID in gone:
+                model[namespace].pop(job_ID, None)
+            gone.clear()
+            known = {
+                (namespace, job_ID): job
+                for namespace, jobs in model.items()
+                for job_ID, job in jobs.items()
+            }
+            policy = new_policy(known, detail_budget, detail_sample)
+            next_dt += interval * 3600
+
+        # Process events until next snapshot
+        try:
+            cluster, msg = merged.get(
+                timeout=max(0, min(60, next_dt - time.monotonic()))
+            )
+        except queue.Empty:
+            continue
+
+        changed = set()
+        for e in msg.get("Events", []):
+            namespace = e.get("Namespace")
+            if namespace not in model:
                 continue
+            if e["Topic"] == "Job":
+                if not is_userjob(e["Payload"]["Job"]["Name"]):
+                    continue
+                job_ID = e["Key"]
+            else:
+                job_ID = e["Payload"]["Allocation"]["JobID"]
+            changed.add((namespace, job_ID))
 
+        for namespace, job_ID in changed:
+            old = model[namespace].get(job_ID)
             try:
-                # Retrieve details of the job
-                snapshot[namespace].append(
-                    get_deployment(deployment_uuid=j["ID"], namespace=namespace)
+                new = get_deployment(
+                    deployment_uuid=job_ID,
+                    namespace=namespace,
+                    full_info=wants_details(policy, namespace, job_ID),
+                    client=patch(cluster["client"]),
                 )
-            except Exception as e:
-                print(f"   Failed to retrieve {j['ID']}")
-
-    # Save snapshot
-    with open(
-        snapshot_dir / f"{datetime.utcnow().replace(microsecond=0).isoformat()}.json",
-        "w",
-    ) as f:
-        json.dump(snapshot, f)
+            except Exception:
+                # Job was purged, keep it until next snapshot
+                if old:
+                    gone.add((namespace, job_ID))
+                continue
+            if not is_userjob(new["name"]):
+                continue
+            new["cluster"] = cluster["name"]
+            new["region"] = cluster["region"]
+            carry_details(policy, namespace, new)
+            events.append(events.transitions(namespace, old, new))
+            model[namespace][job_ID] = new
+            gone.discard((namespace, job_ID))
+
+
+def main(
+    daemon: bool = False,
+    interval: float = 6,
+    retries: int = 3,
+    max_resume: float = 2,
+    detail_budget: int = 200,
+    detail_sample: float = 0.05,
+):
+    """
+    * **daemon**: keep running, updating the snapshot with the Nomad event stream.
+    * **interval**: hours between snapshots (only in daemon mode).
+    * **retries**: number of retry passes (with backoff) for the jobs that failed.
+    * **max_resume**: max age (in hours) of an interrupted snapshot to resume it.
+    * **detail_budget**: max number of jobs per snapshot whose expensive details
+      (templates, active endpoints) are collected (0 to disable).
+    * **detail_sample**: fraction of the unchanged jobs whose details are refreshed.
+    """
+    if daemon:
+        run_daemon(conf.CLUSTERS, interval, detail_budget, detail_sample)
+    else:
+        print("Taking snapshot of the Nomad cluster")
+        take_snapshot(
+            conf.CLUSTERS,
+            retries=retries,
+            max_resume=max_resume,
+            detail_budget=detail_budget,
+            detail_sample=detail_sample,
+        )
+
+
+if __name__ == "__main__":
+    typer.run(main)
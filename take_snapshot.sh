@@ -5,6 +5,7 @@
 # 0 */4 * * * /bin/bash /mnt/ai4-logs/ai4-accounting/take_snapshot.sh
 
 # Export proper Nomad variables
+# (to collect several clusters, configure them in clusters.json instead)
 export NOMAD_ADDR=https://193.146.75.205:4646  # production cluster
 export NOMAD_CACERT=/home/ubuntu/nomad-certs/nomad-federated/nomad-ca.pem
 export NOMAD_CLIENT_CERT=/home/ubuntu/nomad-certs/nomad-federated/cli.pem
@@ -19,6 +20,10 @@ cd $(dirname "$0")
 # Run .py script
 source ./myenv/bin/activate
 python3 take_snapshot.py
+python3 normalize.py
+python3 alerts.py
 python3 summarize.py
+python3 cube.py build
+python3 events.py build
 python3 update-user-db.py
 deactivate
@@ -5,7 +5,6 @@ Add users to a database.
 import json
 from pathlib import Path
 
-import nomad
 import pandas as pd
 
 import conf
@@ -30,37 +29,36 @@ if json_pth.exists():
 else:
     users = {}
 
-# Parse current deployments and add new users
-Nomad = nomad.Nomad()
-namespaces = conf.NAMESPACES
-snapshot = {k: [] for k in namespaces}
-for namespace in namespaces:
-    print(f"  Processing {namespace} ...")
-
-    jobs = Nomad.jobs.get_jobs(namespace=namespace)  # job summaries
-    for j in jobs:
-        # Skip jobs that are not modules or tools
-        # (useful for admins who might have deployed other jobs eg. Traefik)
-        if not (j["Name"].startswith("module-") or j["Name"].startswith("tool-")):
-            print(f"Ignoring {j['Name']}")
-            continue
-
-        try:
-            j = Nomad.job.get_job(
-                id_=j["ID"],
-                namespace=namespace,
-            )
-
-            # Overwrite user info in database
-            id_ = j["Meta"]["owner"]
-            user = users.get(id_, {})
-            for k in keys:
-                if f"owner_{k}" in j["Meta"]:
-                    user[k] = j["Meta"][f"owner_{k}"]
-            users[id_] = user
-
-        except Exception:
-            print(f"   Failed to retrieve {j['ID']}")
+# Parse current deployments (of all clusters) and add new users
+for cluster in conf.CLUSTERS:
+    Nomad = cluster["client"]
+    for namespace in conf.get_namespaces(cluster):
+        print(f"  Processing {cluster['name']}:{namespace} ...")
+
+        jobs = Nomad.jobs.get_jobs(namespace=namespace)  # job summaries
+        for j in jobs:
+            # Skip jobs that are not modules or tools
+            # (useful for admins who might have deployed other jobs eg. Traefik)
+            if not (j["Name"].startswith("module-") or j["Name"].startswith("tool-")):
+                print(f"Ignoring {j['Name']}")
+                continue
+
+            try:
+                j = Nomad.job.get_job(
+                    id_=j["ID"],
+                    namespace=namespace,
+                )
+
+                # Overwrite user info in database
+                id_ = j["Meta"]["owner"]
+                user = users.get(id_, {})
+                for k in keys:
+                    if f"owner_{k}" in j["Meta"]:
+                        user[k] = j["Meta"][f"owner_{k}"]
+                users[id_] = user
+
+            except Exception:
+                print(f"   Failed to retrieve {j['ID']}")
 
 # Save new database to JSON
 with open(json_pth, "w") as f:
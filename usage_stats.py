@@ -4,22 +4,107 @@ Get the accounting reports for a given period.
 
 from copy import deepcopy
 from datetime import datetime
-import json
-from pathlib import Path
+import sys
 
-import rich
+import rich.console
+import rich.table
 import typer
 
+import archive
 import conf
+import normalize
 
 
-snapshot_dir = Path(__file__).resolve().parent / "snapshots"
+# Job fields that can be used as extra group-by dimensions
+dimensions = [
+    "cluster",
+    "region",
+    "datacenter",
+    "docker_image",
+]
+
+
+def parse_time(
+    t: str,
+):
+    """
+    Parse Nomad allocation times (nanosecond precision) to datetimes.
+    """
+    return datetime.strptime(t[:-4], "%Y-%m-%dT%H:%M:%S.%f")  # trim to microseconds
+
+
+def iter_usage(
+    ini_dt: datetime,
+    end_dt: datetime,
+    namespaces: list,
+    prev_snapshot_dt: datetime = None,
+):
+    """
+    Iterate over the job records of the snapshots in the [ini_dt, end_dt] range (one
+    at a time, see `archive.iter_records`), yielding the time interval each job has
+    been running since the previous snapshot.
+
+    * **prev_snapshot_dt**: datetime of the last snapshot before the range (defaults
+      to `ini_dt`).
+
+    Yields tuples `(namespace, job, start, end)`, with `end >= start`.
+    """
+    # Records with missing allocation times or misconfigured resources are fixed once,
+    # at ingestion. Snapshots not normalized yet are fixed in memory.
+    todo = normalize.check_archive()
+    ends = normalize.load_state()["ends"] if todo else {}
+
+    # datetime of last snapshot; starts at ini_date
+    prev_snapshot_dt = deepcopy(prev_snapshot_dt or ini_dt)
+
+    for snapshot_dt, namespace, job in archive.iter_records(ini_dt, end_dt):
+        if namespace == "_meta":
+            # Update snapshot time
+            prev_snapshot_dt = snapshot_dt
+            continue
+        if namespace not in namespaces:
+            continue
+
+        if todo and snapshot_dt.isoformat() in todo:
+            normalize.fix_job(job, ends, snapshot_dt.isoformat())
+
+        # Ignore queued jobs, error jobs, etc
+        if job["status"] not in ["running", "dead"]:
+            continue
+
+        # Ignore dead jobs that failed without ever been deployed
+        if job["status"] == "dead" and not job["alloc_start"]:
+            continue
+
+        # Compute most restrictive start time
+        start = max(prev_snapshot_dt, parse_time(job["alloc_start"]))
+
+        # Compute most restrictive end time
+        if job["status"] == "dead":
+            end = min(snapshot_dt, parse_time(job["alloc_end"]))
+        else:
+            end = snapshot_dt
+
+        # Ignore negative timedeltas (can happen if dead job is repeated from last snapshot)
+        end = max(start, end)
+
+        yield namespace, job, start, end
 
 
 def main(
     ini_date: str = None,
     end_date: str = None,
+    group_by: list[str] = None,
 ):
+    """
+    * **group_by**: also report the accounting per namespace and these job dimensions
+      (`cluster`, `region`, `datacenter`, `docker_image`).
+    """
+    group_by = group_by or []
+    for d in group_by:
+        if d not in dimensions:
+            raise typer.BadParameter(f"Unknown group-by dimension: {d}")
+
     namespaces = conf.NAMESPACES
     accounting = {k: {} for k in namespaces}
     jobset = {
@@ -28,108 +113,46 @@ def main(
     userset = {
         k: set() for k in namespaces
     }  # keep track of number of jobs per namespace
+    grouped = {}  # accounting per (namespace, *group_by)
+    groupjobs = {}  # keep track of number of jobs per (namespace, *group_by)
 
-    snapshot_list = sorted(snapshot_dir.glob("**/*.json"))
+    snapshot_list = archive.list_snapshots()
 
     # Transform to datetimes
     # Use user values or else default to first/last snapshots
     ini_dt = (
-        datetime.strptime(ini_date, "%Y-%m-%d")
-        if ini_date
-        else datetime.strptime(snapshot_list[0].stem, "%Y-%m-%dT%H:%M:%S")
+        datetime.strptime(ini_date, "%Y-%m-%d") if ini_date else snapshot_list[0][0]
     )
     end_dt = (
-        datetime.strptime(end_date, "%Y-%m-%d")
-        if end_date
-        else datetime.strptime(snapshot_list[-1].stem, "%Y-%m-%dT%H:%M:%S")
+        datetime.strptime(end_date, "%Y-%m-%d") if end_date else snapshot_list[-1][0]
     )
     end_dt = end_dt.replace(
         hour=23, minute=59, second=59
     )  # include end_dt in the range
 
-    prev_snapshot_dt = deepcopy(ini_dt)  # datetime of last snapshot; starts at ini_date
-
-    # Keep track of ignored misformated jobs
-    ignored = set()
-
-    for snapshot_pth in snapshot_list:
-        snapshot_dt = datetime.strptime(snapshot_pth.stem, "%Y-%m-%dT%H:%M:%S")
-
-        # Skip files outside the date range
-        if not (ini_dt <= snapshot_dt <= end_dt):
-            continue
-
-        # Load the snapshot
-        with open(snapshot_pth, "r") as f:
-            snapshot = json.load(f)
-
-        for namespace in namespaces:
-            for job in snapshot.get(namespace, []):
-                # Ignore queued jobs, error jobs, etc
-                if job["status"] not in ["running", "dead"]:
-                    continue
-
-                # Ignore dead jobs that failed without ever been deployed
-                if job["status"] == "dead" and not job["alloc_start"]:
-                    continue
-
-                # Ignore dead jobs that are badly formatted
-                # Weird case, but can happen
-                if job["status"] == "dead" and not job["alloc_end"]:
-                    if job["job_ID"] not in ignored:
-                        print(
-                            f"{snapshot_dt.date()} Ignoring: dead with no alloc end (ID: {job['job_ID']})"
-                        )
-                        ignored.add(job["job_ID"])
-                    continue
-
-                # Ignore running jobs that do not have alloc start
-                # Weird case, but can happen
-                if job["status"] == "running" and not job["alloc_start"]:
-                    if job["job_ID"] not in ignored:
-                        print(
-                            f"{snapshot_dt.date()} Ignoring: running with no alloc start (ID: {job['job_ID']})"
-                        )
-                        ignored.add(job["job_ID"])
-                    continue
-
-                # Older jobs where misconfigured (cpuMHz was set instead of cpu_cores)
-                # TODO: remove when old jobs no longer exist
-                if job["resources"]["cpu_num"] == 0:
-                    job["resources"]["cpu_num"] = job["resources"]["cpu_MHz"]
-
-                # Compute most restrictive start time
-                start = datetime.strptime(
-                    job["alloc_start"][:-4], "%Y-%m-%dT%H:%M:%S.%f"
-                )  # trim to microseconds
-                start = max(prev_snapshot_dt, start)
-
-                # Compute most restrictive end time
-                if job["status"] == "dead":
-                    end = datetime.strptime(
-                        job["alloc_end"][:-4], "%Y-%m-%dT%H:%M:%S.%f"
-                    )  # trim to microseconds
-                    end = min(snapshot_dt, end)
-                else:
-                    end = snapshot_dt
-
-                # Compute time delta
-                # Ignore negative timedeltas (can happen if dead job is repeated from last snapshot)
-                seconds = (end - start).total_seconds()
-                seconds = max(0, seconds)
-
-                # Add to overall accounting
-                for k, v in job["resources"].items():
-                    accounting[namespace][k] = (
-                        accounting[namespace].get(k, 0) + v * seconds
-                    )
-
-                # Track job and user
-                jobset[namespace].add(job["job_ID"])
-                userset[namespace].add(job["owner"])
-
-        # Update snapshot time
-        prev_snapshot_dt = snapshot_dt
+    for namespace, job, start, end in iter_usage(
+        ini_dt=ini_dt,
+        end_dt=end_dt,
+        namespaces=namespaces,
+    ):
+        seconds = (end - start).total_seconds()
+
+        # Add to overall accounting
+        for k, v in job["resources"].items():
+            accounting[namespace][k] = accounting[namespace].get(k, 0) + v * seconds
+
+        # Track job and user
+        jobset[namespace].add(job["job_ID"])
+        userset[namespace].add(job["owner"])
+
+        # Add to the accounting per group (computed in the same pass)
+        # Strings are interned so that repeated values share the same key objects
+        if group_by:
+            g = (namespace,) + tuple(sys.intern(job.get(d) or "") for d in group_by)
+            acc = grouped.setdefault(g, {})
+            for k, v in job["resources"].items():
+                acc[k] = acc.get(k, 0) + v * seconds
+            groupjobs.setdefault(g, set()).add(job["job_ID"])
 
     # Convert from resource-seconds to resource-hour
     for namespace in namespaces:
@@ -173,6 +196,25 @@ def main(
     table.add_row("Nº active users", str(len(set.union(*userset.values()))))
     console.print(table, soft_wrap=True)
 
+    # Show table for the accounting per group
+    if group_by:
+        table = rich.table.Table(
+            title=f"Accounting per {', '.join(group_by)} for the period {ini_dt.date()}:{end_dt.date()}",
+        )
+        for k in ["namespace"] + group_by:
+            table.add_column(k, style="cyan")
+        resources = list(list(grouped.values())[0].keys()) if grouped else []
+        for k in resources + ["Nº jobs"]:
+            table.add_column(k if k == "Nº jobs" else f"{k} hours", justify="right")
+        for g in sorted(grouped.keys()):
+            table.add_row(
+                *g,
+                *[str(int(grouped[g][k] / 3600)) for k in resources],
+                str(len(groupjobs[g])),
+                style="pink1",
+            )
+        console.print(table, soft_wrap=True)
+
 
 if __name__ == "__main__":
     typer.run(main)